@@ -0,0 +1,444 @@
+"""
+Module with an approximate backend for counting ngrams, for corpora whose exact counts do not fit in memory or on disk.
+
+ApproximateNgrams counts into a fixed amount of memory, chosen up front, instead of into dicts:
+    - A count-min sketch with conservative update holds the frequencies of the ngrams, and the counts that the
+      Kneser-Ney estimation sums over the ngrams of a string: how often the string is followed by a word
+      (C_KN of the highest order), how many word types follow it once or more, twice or more and three times or more
+      (the succeeding count and the backoff weights), and the continuation counts.
+    - A Bloom filter remembers which ngrams have been seen, so that the counts of types are only added to
+      the first time an ngram is counted.
+    - A HyperLogLog per order estimates the number of distinct ngrams, which the probability of an unknown word needs.
+The vocabulary is kept exactly, since it is small compared to the ngrams and is needed to map words to IDs.
+
+The ngrams are not stored, so the model can not be written as a binary model or an ARPA file. Instead the probabilities
+are calculated when they are asked for, with the same formulas as KneserNey.estimate() and KneserNey.backoff_weights()
+but with the counts taken from the sketches. ApproximateNgrams answers the same queries as BinaryModel (logprob(),
+logprobs(), encode()), so it can be scored with scoring.score_sentences(), and can be saved and loaded.
+
+Error bounds, with W the width and d the depth of the sketch, N the total of all counts added to it,
+m the number of bits and k the number of hashes of the Bloom filter, n the number of distinct ngrams
+and p the precision of the HyperLogLogs:
+    - A count from the sketch is never below the true count, and with probability at least 1 - e^-d
+      it is at most e/W * N above it. Conservative update makes the overestimates smaller in practice.
+    - A new ngram is taken for a seen one with probability about (1 - e^(-kn/m))^k. Counts of types are then
+      too low by about that fraction, and an unseen ngram is taken for a seen one (and gets a probability
+      instead of backing off) with the same probability.
+    - The number of distinct ngrams of an order has a relative standard error of about 1.04 / sqrt(2^p).
+See ApproximateNgrams.error_bounds() for the values of a counted model.
+
+The keys of the sketches are hashed from the word IDs with compact_model._hash() (FNV-1a and the finalizer of splitmix64),
+never with the built-in hash(), so a saved file gives the same counts on every Python version and platform.
+The VERSION of the file format is raised whenever the hashing changes.
+"""
+
+import math
+import struct
+import sys
+from array import array
+from functools import lru_cache
+from compact_model import _hash
+from kneser_ney import discounts
+from ngrams import Ngrams
+from vocabulary import Vocabulary
+import instrumentation
+
+MAGIC = b'NGRAMAP\x00'
+VERSION = 2  # 1 hashed the ngrams with the built-in hash(), which is not the same across Python versions and platforms.
+_HEADER = struct.Struct('=8sIB3xIQIQIIQ4q')
+_BYTE_ORDERS = {'little': 0, 'big': 1}
+_MASK = (1 << 64) - 1
+
+# Salts of the kinds of keys, so that e.g. the frequency of an ngram and the context count of the same ngram
+# get different counters.
+_FREQ = 0x9e3779b97f4a7c15
+_CONTEXT = 0x3c6ef372fe94f82a
+_REACHED = (0xdaa66d2c7ddf743f, 0x78dde6e5fd29f054, 0x1715609d79c06ba9)
+_CONTINUATION = 0xb54cda56f56d2b0e
+_CONTINUATION_STRING = 0x52fe0fb07bbf5a13
+_TYPE = 0xf1bbcdcbfa53e0af
+_DISTINCT = 0x8f1bbcdcbfa53e0b
+
+
+def _mix(h):
+    """Mixes the bits of a 64 bit int, with the finalizer of splitmix64."""
+
+    h &= _MASK
+    h = ((h ^ (h >> 30)) * 0xbf58476d1ce4e5b9) & _MASK
+    h = ((h ^ (h >> 27)) * 0x94d049bb133111eb) & _MASK
+    return h ^ (h >> 31)
+
+
+class CountMinSketch:
+    """A count-min sketch with conservative update, over keys that are 64 bit hashes."""
+
+    def __init__(self, width, depth=4):
+        """Inits CountMinSketch.
+
+        Args:
+            width: The number of counters per row.
+            depth: The number of rows. Each key has one counter per row.
+
+        self.table = The counters of all rows after each other, as unsigned 32 bit ints.
+        self.total = The total of all counts added."""
+
+        self.width = width
+        self.depth = depth
+        self.table = array('I', bytes(4 * width * depth))
+        self.total = 0
+
+    def _indexes(self, h):
+        a = h & 0xffffffff
+        b = (h >> 32) | 1
+        width = self.width
+        return [row * width + (a + row * b) % width for row in range(self.depth)]
+
+    def add(self, h, count=1):
+        """Adds count to a key, raising each of its counters only as far as the new estimate of the key.
+
+        Returns the estimate of the key before the count was added."""
+
+        table = self.table
+        indexes = self._indexes(h)
+        old = min([table[i] for i in indexes])
+        new = min(old + count, 0xffffffff)
+        for i in indexes:
+            if table[i] < new:
+                table[i] = new
+        self.total += count
+        return old
+
+    def query(self, h):
+        """Gets the estimate of a key, which is never below its true count."""
+
+        table = self.table
+        return min([table[i] for i in self._indexes(h)])
+
+
+class BloomFilter:
+    """A Bloom filter over keys that are 64 bit hashes."""
+
+    def __init__(self, n_bits, n_hashes=4):
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+        self.bits = bytearray((n_bits + 7) // 8)
+
+    def _indexes(self, h):
+        a = h & 0xffffffff
+        b = (h >> 32) | 1
+        return [(a + i * b) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, h):
+        """Adds a key. Returns True if it was not in the filter before."""
+
+        bits = self.bits
+        new = False
+        for i in self._indexes(h):
+            byte, bit = i >> 3, 1 << (i & 7)
+            if not bits[byte] & bit:
+                bits[byte] |= bit
+                new = True
+        return new
+
+    def __contains__(self, h):
+        bits = self.bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(h))
+
+    def false_positive_rate(self, n):
+        """Gets the probability that a key not in the filter is taken for one that is, after n keys have been added."""
+
+        return (1 - math.exp(-self.n_hashes * n / self.n_bits)) ** self.n_hashes
+
+
+class HyperLogLog:
+    """A HyperLogLog estimating the number of distinct keys, which are 64 bit hashes."""
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, h):
+        p = self.precision
+        index = h & ((1 << p) - 1)
+        rank = 64 - p - (h >> p).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        """Gets the estimated number of distinct keys, with linear counting while many registers are empty."""
+
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        empty = self.registers.count(0)
+        if estimate <= 2.5 * m and empty:
+            estimate = m * math.log(m / empty)
+        return round(estimate)
+
+    def relative_error(self):
+        return 1.04 / math.sqrt(len(self.registers))
+
+
+class ApproximateNgrams:
+    """Counts ngrams into sketches of a fixed size and estimates their probabilities when asked, see the module docstring.
+
+    Counts sentences like Ngrams (create_ngrams() is shared with it), but has none of its tables,
+    so it can not be merged, updated or written as a binary model. build_model() only gets the discounts."""
+
+    # The counting of Ngrams only uses n, vocab and _count_ngram(), so it is shared instead of copied.
+    create_ngrams = Ngrams.create_ngrams
+    _add_ngrams = Ngrams._add_ngrams
+
+    def __init__(self, n, memory_mb=256, depth=4, bloom_share=0.25, n_hashes=4, hll_precision=14):
+        """Inits ApproximateNgrams.
+
+        Args:
+            n: The highest order of the ngrams.
+            memory_mb: The number of megabytes of the count-min sketch and the Bloom filter together.
+            depth: The depth of the count-min sketch.
+            bloom_share: The share of memory_mb that is used for the Bloom filter.
+            n_hashes: The number of hashes of the Bloom filter.
+            hll_precision: The precision of the HyperLogLogs. Each one takes 2^hll_precision bytes.
+
+        self.n = The highest order of the ngrams.
+        self.vocab = The vocabulary mapping each word type to the integer ID used in the ngram tuples, kept exactly.
+        self.D = The discounts, set by build_model().
+        self.vocab_size = The vocabulary size the uniform probability of the unigrams is based on, set by build_model().
+        self.unk_prob = The logged probability of an unknown word, set by build_model().
+        self.sketch = The CountMinSketch of the frequencies and the counts of the strings.
+        self.types = The BloomFilter of the seen ngrams.
+        self.distinct = A HyperLogLog of the ngrams of each order above 1.
+        self.unigrams = The set of the IDs of the seen words.
+        self.counts_of_counts = The number of ngrams with the counts 1, 2, 3 and 4, kept up to date while counting."""
+
+        self.n = n
+        self.vocab = Vocabulary()
+        self.D = None
+        self.vocab_size = None
+        self.unk_prob = None
+        size = memory_mb * 1024**2
+        self.sketch = CountMinSketch(max(int(size * (1 - bloom_share)) // (4 * depth), 1), depth)
+        self.types = BloomFilter(max(int(size * bloom_share) * 8, 8), n_hashes)
+        self.distinct = [None, None] + [HyperLogLog(hll_precision) for _ in range(2, n+1)]
+        self.unigrams = set()
+        self.counts_of_counts = [0, 0, 0, 0]
+        self._continuation_prob = lru_cache(maxsize=100000)(self._continuation_prob_uncached)
+
+    def _count_ngram(self, ngram, n, count=1):
+        """Adds count to the frequency of an ngram of order n and to the counts of its string, see the module docstring."""
+
+        key = _hash(ngram)
+        old = self.sketch.add(_mix(key ^ _FREQ), count)
+        n_counts = self.counts_of_counts
+        if 1 <= old <= 4:
+            n_counts[old-1] -= 1
+        if old + count <= 4:
+            n_counts[old+count-1] += 1
+
+        if n == 1:
+            self.unigrams.add(ngram[0])
+            return
+
+        new_type = self.types.add(_mix(key ^ _TYPE))
+        self.distinct[n].add(_mix(key ^ _DISTINCT))
+        string = _hash(ngram[:-1])
+        self.sketch.add(_mix(string ^ _CONTEXT), count)
+        for times, salt in enumerate(_REACHED, 1):
+            if (new_type if times == 1 else old < times <= old + count):
+                self.sketch.add(_mix(string ^ salt))
+        if new_type and n > 2:
+            self.sketch.add(_mix(_hash(ngram[1:]) ^ _CONTINUATION))
+            self.sketch.add(_mix(_hash(ngram[2:]) ^ _CONTINUATION_STRING))
+
+    def build_model(self):
+        """Gets the discounts, the vocabulary size and the probability of an unknown word from the counts,
+        after which the model can be queried. Reports the error bounds of the sketches.
+
+        The counts of counts are taken from overestimated frequencies, so in a sketch that is too small
+        the discounts can come out below 0. Each discount d_i is therefore kept between 0.1 and i."""
+
+        with instrumentation.stage('estimation'):
+            D = discounts(self.counts_of_counts)
+            self.D = {bucket: min(max(d, 0.1), bucket) if bucket else d for bucket, d in D.items()}
+            self.vocab_size = len(self.unigrams)
+            n_types = self.vocab_size + sum(hll.count() for hll in self.distinct[2:])
+            self.unk_prob = math.log(self.D[1] / (n_types + 1))
+            self._continuation_prob.cache_clear()
+        bounds = self.error_bounds()
+        instrumentation.message(f'Approximativ modell: frekvenser högst {bounds["frequency_error"]} för höga '
+                                f'(sannolikhet {round(bounds["frequency_confidence"], 4)}), falskt positiva typer '
+                                f'{bounds["type_false_positive_rate"]:.2e}, typer per ordning ±{round(bounds["distinct_relative_error"]*100, 2)}%')
+
+    def error_bounds(self):
+        """Gets the error bounds of the counted sketches, see the module docstring.
+
+        Returns:
+            A dict with:
+                - frequency_error: The most a count from the sketch is above the true count,
+                - frequency_confidence: with this probability.
+                - type_false_positive_rate: The probability that a new ngram is taken for a seen one.
+                - distinct_relative_error: The relative standard error of the number of distinct ngrams of an order.
+                - distinct: The estimated number of distinct ngrams of each order."""
+
+        distinct = {1: len(self.unigrams)}
+        distinct.update({order: self.distinct[order].count() for order in range(2, self.n+1)})
+        return {'frequency_error': math.ceil(math.e / self.sketch.width * self.sketch.total),
+                'frequency_confidence': 1 - math.exp(-self.sketch.depth),
+                'type_false_positive_rate': self.types.false_positive_rate(sum(distinct.values()) - distinct[1]),
+                'distinct_relative_error': self.distinct[2].relative_error() if self.n > 1 else 0.0,
+                'distinct': distinct}
+
+    def nbytes(self):
+        """Gets the number of bytes of the sketches."""
+
+        return (len(self.sketch.table) * 4 + len(self.types.bits)
+                + sum(len(hll.registers) for hll in self.distinct[2:]))
+
+    # Queries, with the same formulas as KneserNey.estimate() and KneserNey.backoff_weights().
+    # Overestimated counts can make a term larger than the exact counts ever can, so the probabilities and
+    # backoff weights are capped at 1 and a string is never followed by more types than its count.
+    def _query(self, ngram, salt):
+        return self.sketch.query(_mix(_hash(ngram) ^ salt))
+
+    def _seen(self, ngram):
+        if len(ngram) == 1:
+            return ngram[0] in self.unigrams
+        return _mix(_hash(ngram) ^ _TYPE) in self.types
+
+    def _reached(self, string):
+        """Gets the number of word types seen after a string at least once, twice and three times."""
+
+        key = _hash(string)
+        reached = [self.sketch.query(_mix(key ^ salt)) for salt in _REACHED]
+        reached[0] = min(reached[0], self.sketch.query(_mix(key ^ _CONTEXT)))
+        reached[1] = min(reached[1], reached[0])
+        reached[2] = min(reached[2], reached[1])
+        return reached
+
+    def _lambda(self, string, d):
+        return d / self._query(string, _FREQ) * self._reached(string)[0]
+
+    def _unigram_prob(self, ngram):
+        d = self.D[min(self._query(ngram, _FREQ), 3)]
+        return max(1 - d, 0) + d / self.vocab_size
+
+    def _continuation_prob_uncached(self, ngram):
+        """Gets the continuation probability of a seen ngram below the highest order. Is called through a cache."""
+
+        if len(ngram) == 1:
+            return self._unigram_prob(ngram)
+        d = self.D[min(self._query(ngram, _FREQ), 3)]
+        continuations = self._query(ngram, _CONTINUATION)
+        continuation_c_KN_string = max(self._query(ngram[:-1], _CONTINUATION_STRING), continuations, 1)
+        return min(max(continuations - d, 0) / continuation_c_KN_string
+                   + self._lambda(ngram[:-1], d) * self._continuation_prob(ngram[1:]), 1.0)
+
+    def prob(self, ngram):
+        """Gets the (not logged) probability of a seen ngram of word IDs."""
+
+        if len(ngram) == 1:
+            return self._unigram_prob(ngram)
+        freq = self._query(ngram, _FREQ)
+        d = self.D[min(freq, 3)]
+        string = ngram[:-1]
+        c_KN_string = max(self._query(string, _CONTEXT), freq)
+        return min(max(freq - d, 0) / c_KN_string + self._lambda(string, d) * self._continuation_prob(ngram[1:]), 1.0)
+
+    def backoff_weight(self, string):
+        """Gets the (not logged) backoff weight of a seen string: the mass the discounts have taken from the ngrams it is prefix of."""
+
+        reached = self._reached(string)
+        D = self.D
+        mass = D[1] * (reached[0] - reached[1]) + D[2] * (reached[1] - reached[2]) + D[3] * reached[2]
+        return min(mass / max(self._query(string, _CONTEXT), 1), 1.0)
+
+    def logprob(self, ids):
+        """Gets the logged probability of the final word of an ngram of word IDs given the other words,
+        backing off like BinaryModel.logprob()."""
+
+        ids = tuple(ids[-self.n:])
+        backoff = 0.0
+        while True:
+            if self._seen(ids):
+                return backoff + math.log(self.prob(ids))
+            if len(ids) == 1:
+                return backoff + self.unk_prob
+
+            string = ids[:-1]
+            if self._seen(string):
+                weight = self.backoff_weight(string)
+                backoff += math.log(weight) if weight > 0 else float('-inf')
+            ids = ids[1:]
+
+    def logprobs(self, ngrams):
+        """Gets the logged probabilities of many ngrams of word IDs at once, as a dict. Every distinct ngram is looked up once."""
+
+        return {ngram: self.logprob(ngram) for ngram in set(ngrams)}
+
+    def encode(self, words):
+        """Converts a sequence of words to a tuple of IDs. Unknown words get the ID of [UNK]."""
+
+        return self.vocab.encode(words, add=False)
+
+    def word(self, word_id):
+        return self.vocab.id2word[word_id]
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def save(self, model_file):
+        """Writes the sketches and the vocabulary to a file."""
+
+        with open(model_file, 'wb') as fhand:
+            fhand.write(_HEADER.pack(MAGIC, VERSION, _BYTE_ORDERS[sys.byteorder], self.n,
+                                     self.sketch.width, self.sketch.depth, self.types.n_bits, self.types.n_hashes,
+                                     self.distinct[2].precision if self.n > 1 else 0, self.sketch.total,
+                                     *self.counts_of_counts))
+            words = [word.encode('utf-8') for word in self.vocab.id2word]
+            fhand.write(struct.pack('=QQ', len(words), len(self.unigrams)))
+            array('I', [len(word) for word in words]).tofile(fhand)
+            fhand.write(b''.join(words))
+            array('I', sorted(self.unigrams)).tofile(fhand)
+            self.sketch.table.tofile(fhand)
+            fhand.write(self.types.bits)
+            for hll in self.distinct[2:]:
+                fhand.write(hll.registers)
+
+    @classmethod
+    def load(cls, model_file):
+        """Reads sketches written by save() and gets the model ready for queries with build_model().
+
+        Raises:
+            ValueError: If the file is not an approximate model file written on a machine with the same byte order."""
+
+        with open(model_file, 'rb') as fhand:
+            (magic, version, byte_order, n, width, depth, n_bits, n_hashes, precision, total,
+             *n_counts) = _HEADER.unpack(fhand.read(_HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f'{model_file} is not an approximate model file of version {VERSION}.')
+            if byte_order != _BYTE_ORDERS[sys.byteorder]:
+                raise ValueError(f'{model_file} was written with another byte order.')
+
+            ngrams = cls(n, memory_mb=0, depth=depth, n_hashes=n_hashes, hll_precision=precision or 14)
+            ngrams.counts_of_counts = n_counts
+            n_words, n_unigrams = struct.unpack('=QQ', fhand.read(16))
+            lengths = array('I')
+            lengths.fromfile(fhand, n_words)
+            blob = fhand.read(sum(lengths))
+            position = sum(lengths[:3])  # [UNK], <s> and </s> are in every vocabulary.
+            for length in lengths[3:]:
+                ngrams.vocab.add(blob[position:position + length].decode('utf-8'))
+                position += length
+            unigrams = array('I')
+            unigrams.fromfile(fhand, n_unigrams)
+            ngrams.unigrams = set(unigrams)
+
+            ngrams.sketch = CountMinSketch(width, depth)
+            ngrams.sketch.total = total
+            ngrams.types = BloomFilter(n_bits, n_hashes)
+            for buffer in [ngrams.sketch.table, ngrams.types.bits] + [hll.registers for hll in ngrams.distinct[2:]]:
+                with memoryview(buffer) as view, view.cast('B') as data:
+                    fhand.readinto(data)
+
+        ngrams.build_model()
+        return ngrams
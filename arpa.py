@@ -0,0 +1,136 @@
+"""
+Module for exporting and importing ngram models in the ARPA format used by most other language model toolkits.
+
+The ARPA file has one section per order, where each line is the log10 probability of an ngram,
+the ngram, and (for all orders but the highest) the log10 backoff weight of the ngram as a string.
+The binary model uses natural logs, so the values are converted when written and read.
+
+Both directions are streaming: the export walks the binary model one order at a time and writes
+the lines in large blocks, and the import reads the file line by line.
+"""
+
+import math
+from binary_model import BinaryModel, write_model
+from vocabulary import Vocabulary
+
+LOG10 = math.log(10)
+UNK = '<unk>'
+NO_PROB = -99.0  # ARPA files use -99 for probabilities of zero.
+
+
+def write_arpa(model, arpa_file, block_size=100000):
+    """Writes a binary model to an ARPA file.
+
+    Args:
+        model: A BinaryModel.
+        arpa_file: A path to the ARPA file to write.
+        block_size: The number of lines joined and written at a time."""
+
+    counts = [len(model.probs[order]) for order in range(1, model.n+1)]
+    with open(arpa_file, 'w', encoding='utf-8', buffering=1024*1024) as fhand:
+        fhand.write('\\data\\\n')
+        for order, count in enumerate(counts, 1):
+            fhand.write(f'ngram {order}={count}\n')
+
+        for order in range(1, model.n+1):
+            fhand.write(f'\n\\{order}-grams:\n')
+            probs = model.probs[order]
+            backoffs = model.backoffs[order] if order < model.n else None
+
+            lines = []
+            for index, words in _ngrams(model, order):
+                line = f'{_log10(probs[index]):.6f}\t{" ".join(words)}'
+                if backoffs is not None:
+                    line += f'\t{_log10(backoffs[index]):.6f}'
+                lines.append(line)
+                if len(lines) == block_size:
+                    fhand.write('\n'.join(lines) + '\n')
+                    lines.clear()
+            if lines:
+                fhand.write('\n'.join(lines) + '\n')
+
+        fhand.write('\n\\end\\\n')
+
+
+def read_arpa(arpa_file, model_file):
+    """Reads an ARPA file and writes it as a binary model file.
+
+    The file is read line by line, and only the word IDs and values of the ngrams are kept in memory.
+    The probability of the <unk> unigram is used as the probability of unknown words,
+    if the file has no <unk> the lowest unigram probability is used.
+
+    Raises:
+        ValueError: If the file is not an ARPA file."""
+
+    vocab = Vocabulary()
+    probs = dict()
+    backoffs = dict()
+    unk_prob = None
+
+    with open(arpa_file, encoding='utf-8') as fhand:
+        for line in fhand:
+            if line.strip() == '\\data\\':
+                break
+        else:
+            raise ValueError(f'{arpa_file} is not an ARPA file.')
+
+        order = None
+        for line in fhand:
+            line = line.strip()
+            if not line or line.startswith('ngram '):
+                continue
+            if line == '\\end\\':
+                break
+            if line.startswith('\\') and line.endswith('-grams:'):
+                order = int(line[1:-len('-grams:')])
+                continue
+            if order is None:
+                raise ValueError(f'{arpa_file} has an ngram outside of a section: {line}')
+
+            fields = line.split()
+            words = [Vocabulary.UNK if word == UNK else word for word in fields[1:order+1]]
+            ngram = vocab.encode(words)
+            probs[ngram] = float(fields[0]) * LOG10
+            if len(fields) > order + 1:
+                backoffs[ngram] = float(fields[order+1]) * LOG10
+            if order == 1 and ngram == (vocab.UNK_ID,):
+                unk_prob = probs[ngram]
+
+    if unk_prob is None:
+        unk_prob = min(prob for ngram, prob in probs.items() if len(ngram) == 1)
+    write_model(model_file, vocab.id2word, probs, backoffs, unk_prob)
+
+
+def convert_to_arpa(model_file, arpa_file):
+    """Writes a binary model file as an ARPA file."""
+
+    with BinaryModel(model_file) as model:
+        write_arpa(model, arpa_file)
+
+
+def _log10(logprob):
+    if logprob == float('-inf'):
+        return NO_PROB
+    return logprob / LOG10
+
+
+def _ngrams(model, order, string=(), index=None):
+    """Yields the index and the words of every ngram of an order, in the order they are stored.
+
+    Walks the trie depth first from the unigrams, so only the words of the current path are kept."""
+
+    depth = len(string) + 1
+    if depth == 1:
+        indices = range(len(model))
+    else:
+        indices = range(model.children[depth-1][index], model.children[depth-1][index+1])
+
+    for child in indices:
+        word_id = child if depth == 1 else model.words[depth][child]
+        word = model.word(word_id)
+        if word == Vocabulary.UNK:
+            word = UNK
+        if depth == order:
+            yield child, string + (word,)
+        else:
+            yield from _ngrams(model, order, string + (word,), child)
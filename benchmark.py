@@ -0,0 +1,290 @@
+"""
+Benchmark suite for the build, estimation and query paths of the ngram model.
+
+Builds a model from a synthetic corpus (or lines sampled from a real corpus) and times every stage,
+recording the peak memory allocated by Python during the stage with tracemalloc:
+    - counting:    Ngrams.create_ngrams() over the lines of the corpus, in memory.
+    - chunk_files: chunk_files.Process reading and counting the corpus file (in parallel if workers is set).
+    - types:       Ngrams._count_types().
+    - estimation:  the discounts, the KneserNey object and Ngrams._get_probabilities().
+    - structure:   Ngrams._structure().
+    - save/load:   writing and opening the binary model, and saving and loading the count state.
+    - generate:    Main.generate_sentence(), timed per generated token,
+                   and beam search and top-k sampling of the same prompts with generation.Generator.
+    - approximate: with --approximate-memory, counting the corpus into sketches of that many megabytes
+                   (see approximate_ngrams.py). The per-token difference of the logged probabilities from the
+                   exact model and the perplexity of both are measured on held out sentences. The approximate model
+                   is not normalized, so a lower perplexity than the exact model's means more error, not a better model.
+
+The corpus is generated from a seed, so two runs with the same arguments count the same text.
+The results are written as JSON, together with the arguments and the Python version and platform,
+so that runs can be compared over time and across build modes (serial, parallel or out of core counting).
+
+tracemalloc slows down the stages that allocate a lot, so for timings only, run with --no-memory.
+
+Usage:
+    python benchmark.py --lines 20000 --n 5 --output results.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+
+import instrumentation
+from binary_model import BinaryModel, write_model
+from approximate_ngrams import ApproximateNgrams
+from build_model import CHUNKS_PER_TASK
+from chunk_files import Process
+from compact_model import compare
+from count_state import load_state, save_state
+from generation import Generator
+from kneser_ney import counts_of_counts, discounts
+from main import Main
+from ngrams import Ngrams, count_lines
+from spilling_ngrams import SpillingNgrams
+
+
+def synthetic_corpus(n_lines, vocab_size=5000, seed=0, min_length=5, max_length=30):
+    """Generates sentences of words drawn from a Zipf distribution, like the words of natural text.
+
+    Returns a list of the sentences, each a string of words separated by spaces and ending with a period."""
+
+    rng = random.Random(seed)
+    words = [f'w{i}' for i in range(vocab_size)]
+    cum_weights = []
+    total = 0.0
+    for rank in range(1, vocab_size + 1):
+        total += 1 / rank
+        cum_weights.append(total)
+
+    lines = []
+    for _ in range(n_lines):
+        length = rng.randint(min_length, max_length)
+        lines.append(' '.join(rng.choices(words, cum_weights=cum_weights, k=length)) + ' .')
+    return lines
+
+
+def sample_corpus(file, n_lines, seed=0):
+    """Samples n_lines lines of a corpus file uniformly (reservoir sampling), keeping the order of the file."""
+
+    rng = random.Random(seed)
+    sample = []
+    with open(file, encoding='utf-8') as fhand:
+        for i, line in enumerate(fhand):
+            if i < n_lines:
+                sample.append((i, line.rstrip('\n')))
+            else:
+                j = rng.randint(0, i)
+                if j < n_lines:
+                    sample[j] = (i, line.rstrip('\n'))
+    return [line for _, line in sorted(sample)]
+
+
+class Benchmark:
+    """Runs the stages of a build and collects their timings and memory use."""
+
+    def __init__(self, trace_memory=True, quiet=True):
+        """Inits Benchmark.
+
+        self.results = A dict with the name of each stage as key and a dict of its measurements as value.
+        self.trace_memory = Whether the peak memory of each stage is traced with tracemalloc.
+        self.quiet = Whether the instrumentation of the stages is turned off while they run, see instrumentation.py."""
+
+        self.results = dict()
+        self.trace_memory = trace_memory
+        self.quiet = quiet
+
+    @contextlib.contextmanager
+    def stage(self, name, **extra):
+        """Times the code run in the with block as a stage, and records the peak memory it allocated.
+
+        Extra measurements can be added to the yielded dict, e.g. the number of items handled.
+        If the dict has an 'items' key, the number of items per second is added too."""
+
+        result = dict(extra)
+        active = instrumentation.current()
+        if self.quiet:
+            instrumentation.disable()
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield result
+        finally:
+            seconds = time.perf_counter() - start
+            instrumentation.use(active)
+            result['seconds'] = seconds
+            if 'items' in result:
+                result['items_per_second'] = result['items'] / seconds if seconds > 0 else None
+            if self.trace_memory:
+                result['peak_memory_mb'] = tracemalloc.get_traced_memory()[1] / 1024**2
+                tracemalloc.stop()
+            result['max_rss_mb'] = instrumentation.max_rss_mb()
+            self.results[name] = result
+
+    def run(self, lines, n, tmp_dir, workers=None, memory_budget=None, generated=20, approximate_memory=None,
+            heldout=None):
+        """Runs all stages on a corpus and returns the results.
+
+        Args:
+            lines: The sentences of the corpus.
+            n: The highest order of the ngrams.
+            tmp_dir: A directory for the corpus, model and state files.
+            workers: If set, chunk_files.Process counts the corpus file with this many processes.
+            memory_budget: If set, the counting stages use SpillingNgrams with this many megabytes.
+            generated: The number of sentences generated, each starting with one of the most frequent words.
+            approximate_memory: If set, an approximate model is also counted with sketches of this many megabytes.
+            heldout: The held out sentences the approximate model is compared with the exact model on."""
+
+        corpus_file = os.path.join(tmp_dir, 'corpus.txt')
+        model_file = os.path.join(tmp_dir, 'model.bin')
+        state_file = os.path.join(tmp_dir, 'model.state')
+        with open(corpus_file, 'w', encoding='utf-8') as fhand:
+            fhand.writelines(line + '\n' for line in lines)
+
+        new_ngrams = partial(SpillingNgrams, n, memory_budget, tmp_dir) if memory_budget else partial(Ngrams, n)
+
+        with self.stage('counting', items=len(lines)):
+            ngrams = new_ngrams()
+            for line in lines:
+                ngrams.create_ngrams(line)
+            if memory_budget:
+                ngrams.merge_runs()
+
+        with self.stage('chunk_files', items=len(lines), workers=workers):
+            process = Process()
+            if workers:
+                counted = Ngrams(n)
+                for shard in process.process_parallel(corpus_file, partial(count_lines, n=n), workers=workers,
+                                                      chunks_per_task=CHUNKS_PER_TASK):
+                    counted.merge_counts(*shard)
+            else:
+                counted = new_ngrams()
+                process.process(corpus_file, counted.create_ngrams)
+                if memory_budget:
+                    counted.merge_runs()
+        del counted
+
+        n_ngrams = len(ngrams.ngram_freqs)
+        with self.stage('types', items=n_ngrams):
+            ngrams._count_types()
+
+        with self.stage('estimation', items=n_ngrams):
+            ngrams.counts_of_counts = counts_of_counts(ngrams.ngram_freqs)
+            ngrams._create_KN(discounts(ngrams.counts_of_counts), len(ngrams.ngram_lists[1]))
+            ngrams._get_probabilities(keep_state=True)
+
+        with self.stage('structure', items=len(ngrams.probs)):
+            ngrams._structure()
+
+        with self.stage('save_model', items=len(ngrams.probs)):
+            write_model(model_file, ngrams.vocab.id2word, ngrams.probs, ngrams.backoffs, ngrams.unk_prob)
+        self.results['save_model']['bytes'] = os.path.getsize(model_file)
+
+        with self.stage('load_model'):
+            model = BinaryModel(model_file)
+            model.logprob(model.encode(['.']))
+
+        if approximate_memory:
+            with self.stage('approximate', items=len(lines), memory_mb=approximate_memory) as result:
+                approximate = ApproximateNgrams(n, approximate_memory)
+                for line in lines:
+                    approximate.create_ngrams(line)
+                approximate.build_model()
+            result['bytes'] = approximate.nbytes()
+            result['error_bounds'] = approximate.error_bounds()
+            if heldout:
+                loss = compare(approximate, model, heldout)
+                loss['approximate_perplexity'] = loss.pop('compact_perplexity')
+                result.update(loss)
+            del approximate
+
+        with self.stage('save_state', items=n_ngrams):
+            save_state(ngrams, state_file)
+        self.results['save_state']['bytes'] = os.path.getsize(state_file)
+
+        with self.stage('load_state', items=n_ngrams):
+            load_state(state_file)
+
+        unigrams = ngrams.ngram_lists[1]
+        first_words = sorted(unigrams, key=unigrams.get, reverse=True)
+        first_words = [ngrams.vocab.id2word[word_id] for (word_id,) in first_words
+                       if word_id > ngrams.vocab.END_ID][:generated]
+        del ngrams
+
+        main = Main()
+        main.n = n
+        main.model = model
+        main.generator = Generator(model)
+        with self.stage('generate', sentences=len(first_words)) as result:
+            result['items'] = sum(len(main.generate_sentence(word).split()) for word in first_words)
+        if result['items']:
+            result['seconds_per_token'] = result['seconds'] / result['items']
+
+        generator = Generator(model, seed=0)
+        with self.stage('beam_search', sentences=len(first_words), width=5) as result:
+            result['items'] = sum(len(words) for words in generator.beam_search(first_words, width=5))
+        with self.stage('sample', sentences=len(first_words), k=40) as result:
+            result['items'] = sum(len(words) for words in generator.sample(first_words, k=40))
+        model.close()
+        return self.results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks building and querying an ngram model.')
+    parser.add_argument('--lines', type=int, default=10000, help='The number of sentences in the corpus.')
+    parser.add_argument('--n', type=int, default=5, help='The highest order of the ngrams.')
+    parser.add_argument('--vocab-size', type=int, default=5000, help='The vocabulary size of the synthetic corpus.')
+    parser.add_argument('--corpus', help='Sample the sentences from this corpus file instead of generating them.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, help='Count the corpus file with this many processes.')
+    parser.add_argument('--memory-budget', type=int, help='Count out of core with a counting buffer of this many megabytes '
+                                                         '(the merged counts are still held in memory).')
+    parser.add_argument('--approximate-memory', type=float,
+                        help='Also count an approximate model with sketches of this many megabytes.')
+    parser.add_argument('--heldout', type=int, default=1000,
+                        help='The number of held out sentences the approximate model is compared on.')
+    parser.add_argument('--generated', type=int, default=20, help='The number of sentences to generate.')
+    parser.add_argument('--no-memory', action='store_true', help='Do not trace the memory (faster, exact timings).')
+    parser.add_argument('--output', help='The JSON file to write the results to. Defaults to standard output.')
+    args = parser.parse_args(args)
+
+    if args.corpus:
+        lines = sample_corpus(args.corpus, args.lines, args.seed)
+    else:
+        lines = synthetic_corpus(args.lines, args.vocab_size, args.seed)
+    heldout = None
+    if args.approximate_memory:
+        if args.corpus:
+            heldout = sample_corpus(args.corpus, args.heldout, args.seed + 1)
+        else:
+            heldout = synthetic_corpus(args.heldout, args.vocab_size, args.seed + 1)
+
+    benchmark = Benchmark(trace_memory=not args.no_memory)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        stages = benchmark.run(lines, args.n, tmp_dir, args.workers, args.memory_budget, args.generated,
+                               args.approximate_memory, heldout)
+
+    report = {
+        'arguments': vars(args),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'stages': stages,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fhand:
+            json.dump(report, fhand, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
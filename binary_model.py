@@ -0,0 +1,404 @@
+"""
+Module containing a binary file format for the ngram model, and a class to query it.
+
+Instead of pickling the nested dicts of the structured model, the model is written as flat arrays
+that can be memory mapped. Opening a model is then almost instant, since nothing is read until
+it is needed, and several processes using the same model file share the same pages of memory.
+
+The ngrams are stored as a trie, one level per order:
+    - The unigrams are stored in the order of their word IDs, so the index of a unigram is its word ID.
+    - The ngrams of order k > 1 are sorted, so that all ngrams with the same string
+      (the ngram without the final word) are next to each other, sorted by their final word.
+      Only the final word of each ngram is stored.
+    - Each ngram of order k < n stores where the ngrams of order k+1 that it is the string of begin and end.
+    - Each order also has a ranking: for every string, the indices of its ngrams sorted by probability,
+      highest first. The most probable next word of a string is then found without scanning its ngrams,
+      and the k most probable are the first k indices of its ranking.
+
+Layout of the file (all sections start at a multiple of 8 bytes, arrays are in native byte order):
+    header:       magic, version, byte order, n, vocabulary size, probability of unknown word,
+                  and the number of ngrams of each order.
+    vocabulary:   V+1 offsets into the vocabulary blob, followed by the UTF-8 encoded words.
+    each order k: final words (not for unigrams), logged probabilities, ranking,
+                  and for k < n the logged backoff weights and the offsets of the ngrams of order k+1.
+"""
+
+import mmap
+import pickle
+import struct
+import sys
+import weakref
+from array import array
+from bisect import bisect_left
+from functools import partial
+from vocabulary import Vocabulary
+import instrumentation
+
+MAGIC = b'NGRAMLM\x00'
+VERSION = 2
+_HEADER = struct.Struct('=8sIB3xIQd')
+_BYTE_ORDERS = {'little': 0, 'big': 1}
+
+
+def _padding(position):
+    return -position % 8
+
+
+def _write_array(fhand, values):
+    """Writes an array to the file and pads it to a multiple of 8 bytes."""
+
+    values.tofile(fhand)
+    size = len(values) * values.itemsize
+    fhand.write(b'\0' * _padding(size))
+
+
+def write_model(model_file, id2word, probs, backoffs, unk_prob):
+    """Writes an ngram model to a binary model file.
+
+    Args:
+        model_file: A path to the file to write.
+        id2word: A list of all words, where index i holds the word with ID i.
+        probs: A dict with tuples of word IDs as keys and their logged probabilities as values.
+        backoffs: A dict with tuples of word IDs as keys and the logged backoff weights of the strings as values.
+        unk_prob: The logged probability of an unknown word.
+
+    Raises:
+        ValueError: If an ngram is in probs, but its string is not."""
+
+    orders = [[]]
+    for ngram in probs:
+        while len(orders) <= len(ngram):
+            orders.append([])
+        orders[len(ngram)].append(ngram)
+    n = len(orders) - 1
+    orders[1] = [(word_id,) for word_id in range(len(id2word))]
+    for ngrams in orders[2:]:
+        ngrams.sort()
+
+    words = [word.encode('utf-8') for word in id2word]
+    word_offsets = array('Q', [0])
+    for word in words:
+        word_offsets.append(word_offsets[-1] + len(word))
+
+    with open(model_file, 'wb') as fhand:
+        fhand.write(_HEADER.pack(MAGIC, VERSION, _BYTE_ORDERS[sys.byteorder], n, len(id2word), unk_prob))
+        fhand.write(b'\0' * _padding(_HEADER.size))
+        _write_array(fhand, array('Q', [len(ngrams) for ngrams in orders[1:]]))
+        _write_array(fhand, word_offsets)
+        fhand.write(b''.join(words))
+        fhand.write(b'\0' * _padding(word_offsets[-1]))
+
+        offsets = array('Q', [0, len(id2word)])
+        for order in range(1, n+1):
+            ngrams = orders[order]
+            ngram_probs = array('f', [probs.get(ngram, unk_prob) for ngram in ngrams])
+            if order > 1:
+                _write_array(fhand, array('I', [ngram[-1] for ngram in ngrams]))
+            _write_array(fhand, ngram_probs)
+            _write_array(fhand, _ranking(ngram_probs, offsets))
+            if order < n:
+                offsets = _child_offsets(ngrams, orders[order+1])
+                _write_array(fhand, array('f', [backoffs.get(ngram, 0.0) for ngram in ngrams]))
+                _write_array(fhand, offsets)
+
+
+def _child_offsets(strings, ngrams):
+    """Gets where the ngrams of each string begin in the sorted ngrams of the next order.
+
+    Both lists are sorted, so the ngrams of each string come in the same order as the strings."""
+
+    offsets = array('Q')
+    i = 0
+    for string in strings:
+        offsets.append(i)
+        while i < len(ngrams) and ngrams[i][:-1] == string:
+            i += 1
+    offsets.append(i)
+    if i != len(ngrams):
+        raise ValueError(f'The string of the ngram {ngrams[i]} is not in the model.')
+    return offsets
+
+
+def _ranking(probs, offsets):
+    """Sorts the ngrams of each string by their probability, highest first.
+
+    The ngrams of each string are sorted by their final word, and the sort is stable,
+    so ngrams with the same probability are ranked by their final word."""
+
+    ranking = array('I')
+    for start, end in zip(offsets, offsets[1:]):
+        ranking.extend(sorted(range(start, end), key=lambda i: -probs[i]))
+    return ranking
+
+
+def convert_pickle(pickle_file, model_file):
+    """Converts a structured model pickled by an earlier version of BuildModel.build_cache() to a binary model file.
+
+    The pickled model has no backoff weights or probability of unknown words.
+    The backoff weights are set to 1 and unknown words get the lowest unigram probability."""
+
+    with open(pickle_file, 'rb') as p:
+        structured = pickle.load(p)
+
+    vocab = Vocabulary()
+    probs = dict()
+    for order in sorted(structured):
+        for ngrams in structured[order].values():
+            if isinstance(ngrams, list):
+                for ngram, prob in ngrams:
+                    probs[vocab.encode(ngram)] = prob
+
+    unk_prob = min(prob for ngram, prob in probs.items() if len(ngram) == 1)
+    write_model(model_file, vocab.id2word, probs, dict(), unk_prob)
+
+
+class BinaryModel:
+    """Class to query an ngram model written by write_model().
+
+    The file is memory mapped and the arrays of each order are memoryviews into the mapped file,
+    so nothing is copied into memory except the vocabulary lookup table, which is built on first use."""
+
+    def __init__(self, model_file):
+        """Opens and memory maps a binary model file.
+
+        self.n = The highest order of the ngrams in the model.
+        self.unk_prob = The logged probability of an unknown word.
+        self.words = The final word IDs of the ngrams of each order (not for unigrams, where the index is the word ID).
+        self.probs = The logged probabilities of the ngrams of each order.
+        self.ranking = The indices of the ngrams of each order, sorted by probability for each string.
+        self.backoffs = The logged backoff weights of the ngrams of each order, as strings of the next order.
+        self.children = Where the ngrams of the next order that an ngram is the string of begin, for each order.
+
+        Raises:
+            ValueError: If the file is not a binary model file written on a machine with the same byte order."""
+
+        self._fhand = open(model_file, 'rb')
+        self._mmap = mmap.mmap(self._fhand.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer = memoryview(self._mmap)
+        self._exported = weakref.WeakValueDictionary()
+
+        magic, version, byte_order, n, vocab_size, unk_prob = _HEADER.unpack_from(self._buffer)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f'{model_file} is not a binary model file of version {VERSION}.')
+        if byte_order != _BYTE_ORDERS[sys.byteorder]:
+            self.close()
+            raise ValueError(f'{model_file} was written with another byte order.')
+
+        self.n = n
+        self.unk_prob = unk_prob
+        self._position = _HEADER.size + _padding(_HEADER.size)
+        counts = [None] + self._read_array('Q', n).tolist()
+
+        self._word_offsets = self._read_array('Q', vocab_size + 1)
+        self._word_blob = self._read_array('B', self._word_offsets[-1])
+        self._word2id = None
+
+        self.words = [None] * (n+2)
+        self.probs = [None] * (n+2)
+        self.ranking = [None] * (n+2)
+        self.backoffs = [None] * (n+2)
+        self.children = [None] * (n+2)
+        for order in range(1, n+1):
+            if order > 1:
+                self.words[order] = self._read_array('I', counts[order])
+            self.probs[order] = self._read_array('f', counts[order])
+            self.ranking[order] = self._read_array('I', counts[order])
+            if order < n:
+                self.backoffs[order] = self._read_array('f', counts[order])
+                self.children[order] = self._read_array('Q', counts[order] + 1)
+
+    def _read_array(self, typecode, length):
+        """Gets a memoryview of the next array in the file."""
+
+        size = length * struct.calcsize(typecode)
+        view = self._buffer[self._position:self._position + size].cast(typecode)
+        self._position += size + _padding(size)
+        return self._export(view)
+
+    def _export(self, view):
+        """Keeps track of a memoryview into the mapped file, so that close() can release it even if it is still referenced."""
+
+        self._exported[id(view)] = view
+        return view
+
+    def close(self):
+        """Releases the memoryviews, also the ones returned by successors(), and closes the file.
+
+        The views can not be used after the model is closed."""
+
+        self.words = self.probs = self.ranking = self.backoffs = self.children = None
+        self._word_offsets = self._word_blob = None
+        for view in list(self._exported.values()):
+            view.release()
+        self._buffer.release()
+        self._mmap.close()
+        self._fhand.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        """The number of words in the vocabulary."""
+
+        return len(self._word_offsets) - 1
+
+    def word(self, word_id):
+        """Gets the word with the given ID."""
+
+        return self._word_blob[self._word_offsets[word_id]:self._word_offsets[word_id+1]].tobytes().decode('utf-8')
+
+    def decode(self, ids):
+        """Converts a sequence of IDs to a tuple of words."""
+
+        return tuple([self.word(word_id) for word_id in ids])
+
+    def encode(self, words):
+        """Converts a sequence of words to a tuple of IDs. Unknown words get the ID of [UNK]."""
+
+        if self._word2id is None:
+            self._word2id = {self.word(word_id): word_id for word_id in range(len(self))}
+        get = self._word2id.get
+        return tuple([get(word, 0) for word in words])
+
+    def find(self, ids):
+        """Gets the index of an ngram in the arrays of its order, or None if the model does not contain it."""
+
+        index = ids[0]
+        if index >= len(self):
+            return None
+        for order in range(1, len(ids)):
+            if order >= self.n:
+                return None
+            words = self.words[order+1]
+            start, end = self.children[order][index], self.children[order][index+1]
+            index = bisect_left(words, ids[order], start, end)
+            if index == end or words[index] != ids[order]:
+                return None
+        return index
+
+    def _successor_range(self, string):
+        """Gets the order and the range of indices of the ngrams that a string of word IDs is the string of.
+
+        The empty string is the string of all unigrams. Returns None if the string has not been seen."""
+
+        order = len(string) + 1
+        if order == 1:
+            return order, 0, len(self)
+        if order > self.n:
+            return None
+        index = self.find(string)
+        if index is None:
+            return None
+        return order, self.children[order-1][index], self.children[order-1][index+1]
+
+    def successors(self, string):
+        """Gets all words that have been seen after a string of word IDs, and their logged probabilities.
+
+        Returns the word IDs and the probabilities as two sequences, which are empty
+        if the string has not been seen. The sequences are views into the mapped file, valid until the model is closed."""
+
+        successor_range = self._successor_range(string)
+        if successor_range is None:
+            return (), ()
+        order, start, end = successor_range
+        if order == 1:
+            return range(start, end), self.probs[order]
+        return self._export(self.words[order][start:end]), self._export(self.probs[order][start:end])
+
+    def ranked(self, string):
+        """Yields the words seen after a string of word IDs, most probable first, as (word ID, logged probability) tuples.
+
+        Uses the ranking, so the words can be taken one at a time without sorting them."""
+
+        successor_range = self._successor_range(string)
+        if successor_range is None:
+            return
+        order, start, end = successor_range
+        words, probs, ranking = self.words[order], self.probs[order], self.ranking[order]
+        for j in range(start, end):
+            i = ranking[j]
+            yield (i if order == 1 else words[i]), probs[i]
+
+    def top_k(self, string, k):
+        """Gets the k most probable words after a string of word IDs.
+
+        Uses the ranking, so only the k words are looked at, not all words seen after the string.
+        Returns a list of (word ID, logged probability) tuples, most probable first."""
+
+        successor_range = self._successor_range(string)
+        if successor_range is None:
+            return []
+        order, start, end = successor_range
+        words, probs = self.words[order], self.probs[order]
+        if order == 1:
+            return [(i, probs[i]) for i in self.ranking[order][start:min(start + k, end)]]
+        return [(words[i], probs[i]) for i in self.ranking[order][start:min(start + k, end)]]
+
+    def best(self, string):
+        """Gets the most probable word after a string of word IDs as a (word ID, logged probability) tuple.
+
+        Returns None if the string has not been seen."""
+
+        top = self.top_k(string, 1)
+        return top[0] if top else None
+
+    def logprob(self, ids):
+        """Gets the logged probability of the final word of an ngram of word IDs given the other words.
+
+        If the model does not contain the ngram, backs off to the ngram without the first word,
+        adding the backoff weight of the string if the model contains it.
+        A word the model has never seen gets the probability of an unknown word."""
+
+        return self._backoff_logprob(tuple(ids[-self.n:]), self.find)
+
+    def logprobs(self, ngrams):
+        """Gets the logged probabilities of many ngrams of word IDs at once, see logprob().
+
+        Every distinct ngram is looked up once, and the lookups in the trie are cached,
+        so ngrams and strings that share a beginning only search the shared part once.
+        Returns a dict with the ngrams as keys and their logged probabilities as values."""
+
+        cache = dict()
+        find = partial(self._find_cached, cache=cache)
+        logprobs = {ngram: self._backoff_logprob(tuple(ngram[-self.n:]), find) for ngram in set(ngrams)}
+        instrumentation.count('lookups', len(cache))
+        return logprobs
+
+    def _find_cached(self, ids, cache):
+        """Like find(), but looks up the ngram without its final word through the cache."""
+
+        if ids in cache:
+            return cache[ids]
+        if len(ids) == 1:
+            index = ids[0] if ids[0] < len(self) else None
+        elif len(ids) > self.n:
+            index = None
+        else:
+            index = self._find_cached(ids[:-1], cache)
+            if index is not None:
+                order = len(ids)
+                words = self.words[order]
+                start, end = self.children[order-1][index], self.children[order-1][index+1]
+                index = bisect_left(words, ids[-1], start, end)
+                if index == end or words[index] != ids[-1]:
+                    index = None
+        cache[ids] = index
+        return index
+
+    def _backoff_logprob(self, ids, find):
+        backoff = 0.0
+        while True:
+            index = find(ids)
+            if index is not None:
+                return backoff + self.probs[len(ids)][index]
+            if len(ids) == 1:
+                return backoff + self.unk_prob
+
+            string = find(ids[:-1])
+            if string is not None:
+                backoff += self.backoffs[len(ids)-1][string]
+            ids = ids[1:]
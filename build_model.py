@@ -1,11 +1,82 @@
 import xml.etree.ElementTree as ET
 from pathlib import Path
-from ngrams import Ngrams
-from BraProjekt.Ngrams.chunk_files import Process
-import pickle
+from ngrams import Ngrams, count_lines
+from spilling_ngrams import SpillingNgrams
+from approximate_ngrams import ApproximateNgrams
+from chunk_files import Process
+from functools import partial
+from binary_model import BinaryModel, write_model
+from arpa import convert_to_arpa
+from segmented_model import write_segments
+from compact_model import CompactModel, compare, report
+from count_state import load_checkpoint, load_state, save_checkpoint, save_state
+from pruning import prune
+from scoring import score_sentences
+import os
+import shutil
+import tempfile
 import time
-from xml.etree.cElementTree import iterparse
-import csv
+from multiprocessing import Pool
+import instrumentation
+import pickle
+from xml.etree.ElementTree import iterparse, ParseError
+
+# The number of chunks a worker counts together when the corpus is counted in parallel. Each task sends back
+# one set of counts, so the parent merges a result per CHUNKS_PER_TASK chunks instead of per chunk.
+CHUNKS_PER_TASK = 16
+
+
+def extract_sentences(xmlpath):
+    """Extracts the sentences of an XML-file from the UN-corpus.
+
+    The file is parsed with iterparse and each sentence element is cleared when its text
+    has been extracted, and removed from the root, so the memory used does not grow with the size of the file.
+
+    Yields each sentence as a string of its words separated by spaces."""
+
+    root = None
+    sentence = []
+    for event, elem in iterparse(xmlpath, events=('start', 'end')):
+        if root is None:
+            root = elem
+        if event == 'start':
+            continue
+        if elem.tag == 'w':
+            if elem.text:
+                sentence.append(elem.text)
+        elif elem.tag == 'sentence':
+            yield ' '.join(sentence)
+            sentence.clear()
+            elem.clear()
+            root.clear()
+
+
+def _extract_file(xmlpath, spool_dir=None):
+    """Extracts the sentences of a file to a temporary spool file, one sentence per line.
+
+    The sentences are written as they are extracted, so the memory used does not grow with the size of the file.
+    Used by BuildModel.create_corpus() in the worker processes, so it returns errors instead of raising them.
+    The spool file of a file that fails is removed, whatever the failure.
+
+    Returns a tuple of the path, the spool file, the number of sentences and the error,
+    where either the spool file or the error is None."""
+
+    fd, spool = tempfile.mkstemp(suffix='.spool', dir=spool_dir)
+    n_sentences = 0
+    complete = False
+    try:
+        with open(fd, 'w', encoding='utf-8') as output:
+            for sentence in extract_sentences(xmlpath):
+                output.write(sentence + '\n')
+                n_sentences += 1
+        complete = True
+    except (ParseError, OSError, UnicodeDecodeError) as error:
+        return xmlpath, None, 0, repr(error)
+    finally:
+        if not complete:
+            os.remove(spool)
+    return xmlpath, spool, n_sentences, None
+
 
 class BuildModel:
     """Driver class to create a ngram model.
@@ -15,106 +86,323 @@ class BuildModel:
         - build a cached model which can be extracted out of the pickle file created."""
 
     def __init__(self, n):
+        """Inits BuildModel.
+
+        self.ngrams = The Ngrams object the corpus is counted into.
+        self.checkpoint_file = The checkpoint file of the build running, see build_cache().
+        self.checkpoint_interval = The least number of seconds between two checkpoints while counting."""
+
         self.ngrams = Ngrams(n)
+        self.checkpoint_file = None
+        self.checkpoint_interval = None
+        self._last_checkpoint = None
 
-    def create_corpus(self, path, output_file):
+    def create_corpus(self, path, output_file, workers=None, report_every=1000):
         """Creates a corpus out of an XML-file containing text data from a UN-corpus.
         
         It is assumed that the corpus is located in several different 
         XML-files in several different nested folders. All these files
-        are extracted with the use of the Path module and then each 
-        processed in turn. The helper function extract_xml() extracts the text from
-        each file and writes it to a new corpus file.
+        are found with the use of the Path module, sorted by path, and handed to a pool of
+        worker processes, where the helper function extract_sentences() extracts the text
+        of each file into a spool file next to the corpus file. The spool files are appended
+        to the corpus file, which is only opened once, in the sorted order of the files,
+        so the corpus is the same on every run and on every file system.
+        
+        Files that can not be parsed are counted and reported at the end instead of stopping the extraction.
         
         Args:
-            path: A path leading to a the directory of a corpus."""
+            path: A path leading to a the directory of a corpus.
+            output_file: A path to the corpus file to write.
+            workers: The number of worker processes. If None the files are extracted in this process.
+            report_every: How many files to extract between each progress report (see instrumentation.progress()).
+            
+        Returns:
+            A list of (file, error) tuples of the files that could not be extracted."""
+
+        files = sorted(f for f in Path(path).glob('**/*') if f.is_file())
+        extract = partial(_extract_file, spool_dir=os.path.dirname(os.path.abspath(output_file)))
+        failed = []
+        n_files = 0
 
-        rootdir = Path(path)
-        file_list = [f for f in rootdir.glob('**/*') if f.is_file()]
-        n = 0
+        with instrumentation.stage('extraction'), open(output_file, 'a', encoding='utf-8') as output:
+            if workers:
+                pool = Pool(workers)
+                results = pool.imap(extract, files, chunksize=16)
+            else:
+                pool = None
+                results = map(extract, files)
 
-        for file in file_list:
             try:
-                if n % 1000 == 0:
-                    print(n)
-                self.extract_xml(file, output_file)  
-            except:
-                pass
-            n += 1
+                for file, spool, n_sentences, error in results:
+                    if error is None:
+                        with open(spool, encoding='utf-8') as fhand:
+                            shutil.copyfileobj(fhand, output)
+                        os.remove(spool)
+                        instrumentation.count('sentences', n_sentences)
+                    else:
+                        failed.append((file, error))
+                        instrumentation.count('failed files')
+                    instrumentation.count('files')
+                    n_files += 1
+                    if n_files % report_every == 0:
+                        instrumentation.progress('extraction', n_files)
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
 
-    def extract_xml(self, xmlpath, outputfile, max=3000000):
-        """Extracts the text from an XML-file and writes it to a new file."""
+        for file, error in failed:
+            instrumentation.message(f'Failed to extract {file}: {error}')
+        return failed
+
+    def extract_xml(self, xmlpath, outputfile):
+        """Extracts the text from an XML-file and appends it to a file."""
 
-        n = 0
         with open(outputfile, 'a', encoding='utf-8') as output:
-            sentence = []
-            for event, elem in iterparse(xmlpath):
-                breakpoint
-                if elem.tag == 'w':
-                    sentence.append(elem.text)
-                elif elem.tag == 'sentence':
-                    sent = ' '.join(sentence) + '\n'
-                    output.write(sent)
-                    sentence.clear()
-                if n % 100000 == 0:
-                    print(f'{round((n / max)*100, 2)}% processed, ({n} out of {max} lines)')
-                n += 1
-
-    def build_cache(self, file, pickle_file=False, csv_file=False, pickle_ngrams=False, max=200000):
+            for sentence in extract_sentences(xmlpath):
+                output.write(sentence + '\n')
+
+    def build_cache(self, file, model_file=False, arpa_file=False, pickle_ngrams=False, max=200000, workers=None,
+                    memory_budget=None, tmp_dir=None, state_file=False, cutoffs=None, target_size=None,
+                    threshold=None, heldout_file=None, segments_dir=False, compact_file=False, compact_bits=16,
+                    exact_keys=False, checkpoint_file=False, checkpoint_interval=600, resume=False):
         """Builds a cached ngram-model out of the corpus provided.
         
         Uses the Ngram class in the ngram.py module to create the model.
-        After the model is created, pickles the model for future use.
-        Can also write all ngrams to a csv file.
+        After the model is created, writes the model to a binary model file for future use
+        (see binary_model.py).
+        Can also write the model to an ARPA file (see arpa.py).
         
         Args:
             file: A path to a corpus file.
+            model_file: A path to the binary model file to write.
+            arpa_file: A path to an ARPA file to write. The ARPA file is written from the binary model file,
+                       so model_file has to be given too.
             n: The highest order ngram that the model should create.
             max: The max amount of lines to be read from the corpus. 
                  The size of the model grows extremely fast with the size of n.
                  Be careful not to set n and max to high.
+            workers: If set, the chunks of the corpus are counted in parallel by this many processes.
+                     Each process counts its chunks into its own Ngrams object, 
+                     and these are merged into self.ngrams in the order of the chunks.
+                     The orders are then also estimated by this many processes, see parallel_estimation.py.
+            memory_budget: If set, the ngrams are counted out of core with SpillingNgrams (see spilling_ngrams.py),
+                           using a counting buffer of about this many megabytes. The budget only covers
+                           the counting: the merged counts and the estimation take as much memory as without it.
+            tmp_dir: The directory of the temporary files used when memory_budget is set.
+            state_file: A path to save the counts and estimation state to, so that the model
+                        can be updated with new text later, see update_cache().
+                        The state has all counted ngrams, also the ones that are pruned.
+            cutoffs: A dict with the lowest frequency an ngram of each order must have to be kept in the model,
+                     e.g. {3: 2, 4: 2, 5: 3}. See pruning.py.
+            target_size: If set, the model is pruned with relative entropy pruning down to this many ngrams.
+            threshold: If set (and not target_size), the ngrams whose relative entropy is below this are pruned.
+            heldout_file: A path to a file with one sentence per line. If given together with model_file,
+                          the size and the perplexity of the written model on these sentences are reported.
+            segments_dir: A path to a directory to also write the model to as segments that are loaded lazily
+                          (see segmented_model.py). The segments are split from the model file,
+                          so model_file has to be given too.
+            compact_file: A path to also write the model to as a compact model with quantized values
+                          (see compact_model.py). The size and the errors of the quantization are reported,
+                          and with heldout_file also how much the logged probabilities of its tokens change.
+            compact_bits: The number of bits of the quantized values of the compact model, 8 or 16.
+            exact_keys: Whether the compact model has exact keys instead of hashes.
+            checkpoint_file: A path to save checkpoints of the build to (see count_state.py), so that a build
+                             that crashes can be resumed. A checkpoint is saved when the counting is done,
+                             when the discounts are done and when each order is estimated, and while counting
+                             every checkpoint_interval seconds (unless memory_budget is set).
+                             The file is removed when the model has been written.
+            checkpoint_interval: The least number of seconds between two checkpoints while counting.
+            resume: Whether to resume the build from checkpoint_file if it exists, skipping the stages
+                    it has done and counting the rest of the corpus from where the checkpoint stopped.
+                    The other arguments should be the same as for the build that saved it.
                  """
         
-        start = time.time()
-        hundredth = max / 100
-        if max <= 50000:
-            with open(file, 'r', encoding='utf-8') as fhand:
-                m = 0
-                for line in fhand:
-                    self.ngrams.create_ngrams(line.rstrip('\n'))
-                    m += 1
-                    if m == max:
-                        break
-                    elif m % hundredth == 0:
-                        print(f'{round((m / max)*100, 2)}% processat, ({m} utav {max} antal rader)')
+        if (arpa_file or segments_dir or compact_file) and not model_file:
+            raise ValueError('An ARPA file, segments or a compact model can only be written together with a model file.')
 
-        else:
-            process = Process()
-            process.process(file, self.ngrams.create_ngrams, max_lines=max)
-            
-        print(time.time() - start)
+        self.checkpoint_file = checkpoint_file or None
+        self.checkpoint_interval = checkpoint_interval
+        self._last_checkpoint = time.monotonic()
+        done, order, offset, n_lines = 'counting', 0, 0, 0
+        if resume and checkpoint_file and os.path.exists(checkpoint_file):
+            ngrams, (done, order, offset, n_lines) = load_checkpoint(checkpoint_file)
+            if ngrams.n != self.ngrams.n:
+                raise ValueError(f'The checkpoint in {checkpoint_file} has n = {ngrams.n}, not {self.ngrams.n}.')
+            self.ngrams = ngrams
+            instrumentation.message(f'Fortsätter från {checkpoint_file}: {done}, {n_lines} rader räknade')
+
+        if done == 'counting':
+            if memory_budget and not offset:
+                self.ngrams = SpillingNgrams(self.ngrams.n, memory_budget, tmp_dir)
+
+            with instrumentation.stage('counting'):
+                self._count_corpus(file, max, workers, offset, n_lines)
+                
+            if isinstance(self.ngrams, SpillingNgrams):
+                with instrumentation.stage('merge runs', runs=len(self.ngrams.runs)):
+                    self.ngrams.merge_runs()
+            done = 'counted'
+            self._checkpoint(done)
 
         if pickle_ngrams:
             with open(pickle_ngrams, 'wb') as picklehand:
                 pickle.dump(self.ngrams, picklehand)
-            exit()
+            return
+
+        checkpoint = self._checkpoint if self.checkpoint_file else None
+        self.ngrams.build_model(keep_state=bool(state_file), checkpoint=checkpoint, resume=(done, order), workers=workers)
+        self._write(model_file, arpa_file, state_file, cutoffs, target_size, threshold, heldout_file, segments_dir,
+                    compact_file, compact_bits, exact_keys)
+        if self.checkpoint_file:
+            os.remove(self.checkpoint_file)
+            self.checkpoint_file = None
 
-        structured_ngrams, ngram_probs = self.ngrams.build_model()
+    def update_cache(self, state_file, file, model_file=False, arpa_file=False, max=200000, workers=None, tolerance=0.01,
+                     cutoffs=None, target_size=None, threshold=None, heldout_file=None, segments_dir=False,
+                     compact_file=False, compact_bits=16, exact_keys=False):
+        """Updates a model with a new slice of the corpus, without counting the old corpus again.
+
+        Loads the state saved by build_cache(state_file=...), counts the new corpus slice,
+        and adds its counts to the state with Ngrams.update(), which only re-estimates the ngrams
+        whose probabilities the new counts change. Then writes the model and the updated state.
+
+        Args:
+            state_file: A path to a state saved by build_cache() or an earlier update_cache().
+            file: A path to the new corpus slice.
+            tolerance: How much (relatively) the discounts and the vocabulary size may change before
+                       the whole model is re-estimated, see Ngrams.update().
+            The other arguments are the same as for build_cache()."""
 
-        print('Picklar...')
-        if pickle_file:
-            with open(pickle_file, 'wb') as picklehand:
-                pickle.dump(structured_ngrams, picklehand)
+        if (arpa_file or segments_dir or compact_file) and not model_file:
+            raise ValueError('An ARPA file, segments or a compact model can only be written together with a model file.')
+
+        state = load_state(state_file)
+        if state.n != self.ngrams.n:
+            raise ValueError(f'The state in {state_file} has n = {state.n}, not {self.ngrams.n}.')
+
+        with instrumentation.stage('counting'):
+            self._count_corpus(file, max, workers)
+
+        with instrumentation.stage('update'):
+            state.update(self.ngrams, tolerance)
+        self.ngrams = state
+        self._write(model_file, arpa_file, state_file, cutoffs, target_size, threshold, heldout_file, segments_dir,
+                    compact_file, compact_bits, exact_keys)
+
+    def build_approximate(self, file, model_file, memory_mb=256, max=200000, heldout_file=None):
+        """Builds an approximate model of the corpus in a fixed amount of memory, see approximate_ngrams.py.
+
+        The ngrams are counted into sketches instead of tables, so the memory used does not grow with
+        the number of distinct ngrams. The probabilities are estimated from the sketches when they are queried,
+        so the model is written as sketches (see ApproximateNgrams.save()) and not as a binary model or an ARPA file.
+
+        Args:
+            file: A path to a corpus file.
+            model_file: A path to the file to write the sketches to.
+            memory_mb: The number of megabytes of the sketches.
+            max: The max amount of lines to be read from the corpus.
+            heldout_file: A path to a file with one sentence per line. If given, the perplexity
+                          of the model on these sentences is reported.
+
+        Returns:
+            The ApproximateNgrams object, ready for queries."""
+
+        self.ngrams = ApproximateNgrams(self.ngrams.n, memory_mb)
+        with instrumentation.stage('counting'):
+            self._count_corpus(file, max, workers=None)
+        self.ngrams.build_model()
+
+        with instrumentation.stage('writing model'):
+            self.ngrams.save(model_file)
+        if heldout_file:
+            with open(heldout_file, encoding='utf-8') as fhand:
+                _, _, perplexity = score_sentences(self.ngrams, [line.rstrip('\n') for line in fhand])
+            instrumentation.message(f'{model_file}: {round(self.ngrams.nbytes() / 1024**2, 2)} MB, '
+                                    f'perplexitet {round(perplexity, 2)}')
+        return self.ngrams
+
+    def _count_corpus(self, file, max, workers, offset=0, n_lines=0):
+        """Counts the ngrams of the corpus into self.ngrams, see build_cache().
+
+        Starts at the byte offset offset, where n_lines lines have already been counted,
+        and saves a checkpoint after a chunk if checkpoint_interval seconds have passed since the last one."""
+
+        process = Process()
+        if workers:
+            batches = process.process_parallel(file, partial(count_lines, n=self.ngrams.n), max_lines=max - n_lines,
+                                               workers=workers, start=offset, chunks_per_task=CHUNKS_PER_TASK)
+        else:
+            batches = process.batches(file, max_lines=max - n_lines, start=offset)
+
+        for batch in batches:
+            if workers:
+                self.ngrams.merge_counts(*batch)
+            else:
+                for line in batch:
+                    self.ngrams.create_ngrams(line)
+            if (self.checkpoint_file and not isinstance(self.ngrams, SpillingNgrams)
+                    and time.monotonic() - self._last_checkpoint >= self.checkpoint_interval):
+                self._checkpoint('counting', offset=process.offset, n_lines=n_lines + process.n_lines)
+
+    def _checkpoint(self, stage, order=0, offset=0, n_lines=0):
+        """Saves a checkpoint of self.ngrams to self.checkpoint_file, if there is one. See count_state.save_checkpoint()."""
+
+        if not self.checkpoint_file:
+            return
+        with instrumentation.stage('saving checkpoint', after=stage):
+            save_checkpoint(self.ngrams, self.checkpoint_file, stage, order, offset, n_lines)
+        self._last_checkpoint = time.monotonic()
+
+    def _write(self, model_file, arpa_file, state_file, cutoffs=None, target_size=None, threshold=None, heldout_file=None,
+               segments_dir=False, compact_file=False, compact_bits=16, exact_keys=False):
+        """Writes the estimated model to the files that are given, pruned if any pruning is asked for."""
+
+        probs, backoffs = self.ngrams.probs, self.ngrams.backoffs
+        if model_file and (cutoffs or target_size is not None or threshold is not None):
+            with instrumentation.stage('pruning'):
+                probs, backoffs = prune(self.ngrams, cutoffs, target_size, threshold)
+
+        if model_file:
+            with instrumentation.stage('writing model'):
+                write_model(model_file, self.ngrams.vocab.id2word, probs, backoffs, self.ngrams.unk_prob)
+            if heldout_file:
+                self._evaluate(model_file, heldout_file)
         
-        print('Skriver till csv...')
-        if csv_file:
-            with open(csv_file, 'w', newline='', encoding='utf-8') as fhand:
-                writer = csv.writer(fhand, delimiter=',')
-                
-                m = 0
-                max = len(ngram_probs)
-                for ngram_prob in ngram_probs.items():
-                    writer.writerow([ngram_prob])
-                    if m % 10000 == 0:
-                        print(f'{round((m / max)*100, 2)}% processat, ({m} utav {max} antal rader)')
-                    m += 1
+        if segments_dir:
+            with instrumentation.stage('writing segments'):
+                write_segments(model_file, segments_dir)
+
+        if compact_file:
+            with instrumentation.stage('writing compact model'):
+                compact = CompactModel.build(self.ngrams.vocab.id2word, probs, backoffs, self.ngrams.unk_prob,
+                                             compact_bits, exact_keys)
+                compact.save(compact_file)
+            report(compact, len(probs))
+            if heldout_file:
+                self._evaluate_compact(compact, model_file, heldout_file)
+
+        if arpa_file:
+            with instrumentation.stage('writing ARPA'):
+                convert_to_arpa(model_file, arpa_file)
+
+        if state_file:
+            with instrumentation.stage('saving state'):
+                save_state(self.ngrams, state_file)
+
+    def _evaluate(self, model_file, heldout_file):
+        """Reports the size of a model file and its perplexity on the sentences of a held out file."""
+
+        with open(heldout_file, encoding='utf-8') as fhand, BinaryModel(model_file) as model:
+            sentences = [line.rstrip('\n') for line in fhand]
+            _, _, perplexity = score_sentences(model, sentences)
+            instrumentation.message(f'{model_file}: {model.n} ordningar, {sum(len(model.probs[order]) for order in range(1, model.n+1))} ngrams, '
+                  f'{round(os.path.getsize(model_file) / 1024**2, 2)} MB, perplexitet {round(perplexity, 2)}')
+
+    def _evaluate_compact(self, compact, model_file, heldout_file):
+        """Reports how much a compact model changes the logged probabilities and the perplexity on a held out file."""
+
+        with open(heldout_file, encoding='utf-8') as fhand, BinaryModel(model_file) as model:
+            loss = compare(compact, model, [line.rstrip('\n') for line in fhand])
+            instrumentation.message(f'Kompakt modell: fel per token {loss["mean"]:.4f} i snitt, {loss["max"]:.4f} max, '
+                                    f'perplexitet {round(loss["compact_perplexity"], 2)} (exakt {round(loss["perplexity"], 2)})')
@@ -1,38 +1,165 @@
+"""
+Module for reading a large text file in chunks of whole lines, serially or with a pool of worker processes.
+
+The file is memory mapped, and split into chunks of about chunk_size bytes that end right after a newline,
+so no line is split between two chunks and every byte is in exactly one chunk. A chunk is decoded straight
+from the map, without first copying it into a bytes object, and split into lines on '\\n' only
+(a '\\r' before it is dropped, like in text mode).
+
+If max_lines is given, the chunks are cut so that exactly the first max_lines lines are read:
+the newlines of each chunk are counted when it is split off, and only the chunk holding line max_lines
+is searched line by line, so that it ends right after that line. The worker processes therefore never read past the limit.
+
+The reading can start at a byte offset where an earlier reading stopped (Process.offset after a chunk),
+e.g. to resume counting a corpus from a checkpoint.
+"""
+
+import mmap
 import os
+from itertools import islice
+from multiprocessing import Pool
+import instrumentation
+
+CHUNK_SIZE = 1024*1024
+
+
+def _split_lines(mapped, start, end, encoding):
+    """Decodes the bytes start:end of a memory mapped file and splits them into lines."""
+
+    with memoryview(mapped) as view, view[start:end] as chunk:
+        text = str(chunk, encoding)
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    if '\r' in text:
+        lines = [line[:-1] if line.endswith('\r') else line for line in lines]
+    return lines
+
+
+def _read_chunks(task):
+    """Reads the lines of a run of consecutive chunks of a file and applies a function to them.
+
+    The function gets an iterator over the lines of all the chunks, which are read one chunk at a time,
+    so a task of many chunks does not hold all their lines in memory. The function must consume all lines.
+    Runs in the worker processes of Process.process_parallel(), so it has to be a module level function."""
+
+    chunks, file, encoding, func = task
+    n_lines = 0
+
+    with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        def lines():
+            nonlocal n_lines
+            for chunkStart, chunkEnd in chunks:
+                chunk_lines = _split_lines(mapped, chunkStart, chunkEnd, encoding)
+                n_lines += len(chunk_lines)
+                yield from chunk_lines
+
+        result = func(lines())
+    return chunks[-1][1], n_lines, result
+
+
+def _chunkify(mapped, size=CHUNK_SIZE, max_lines=None, start=0):
+    """Yields the (start, end) byte offsets of the chunks of a memory mapped file, see the module docstring."""
+
+    fileEnd = len(mapped)
+    n_lines = 0
+    chunkEnd = start
+    while chunkEnd < fileEnd:
+        chunkStart = chunkEnd
+        newline = mapped.find(b'\n', min(chunkStart + size, fileEnd) - 1)
+        chunkEnd = fileEnd if newline == -1 else newline + 1
+
+        if max_lines is not None:
+            # The lines are counted in C on a copy of the chunk, and only the chunk holding line max_lines
+            # is searched line by line for where to cut it. A last line without a newline counts too.
+            chunk_lines = mapped[chunkStart:chunkEnd].count(b'\n') + (newline == -1)
+            if n_lines + chunk_lines >= max_lines:
+                position = chunkStart
+                while n_lines < max_lines:
+                    newline = mapped.find(b'\n', position, chunkEnd)
+                    position = chunkEnd if newline == -1 else newline + 1
+                    n_lines += 1
+                yield chunkStart, position
+                return
+            n_lines += chunk_lines
+        yield chunkStart, chunkEnd
+
 
 class Process:
 
-    def __init__(self) -> None:
-        #init objects
+    def __init__(self, chunk_size=CHUNK_SIZE) -> None:
+        """Inits Process.
+
+        Args:
+            chunk_size: The number of bytes of a chunk, which is extended to the end of its last line.
+
+        self.n_lines = The number of lines read so far.
+        self.offset = The byte offset in the file right after the last chunk handed to the caller."""
+
+        self.chunk_size = chunk_size
         self.n_lines = 0
+        self.offset = 0
+
+    def _chunks(self, file, max_lines, start):
+        """Yields the (start, end) byte offsets of the chunks of a file. An empty file has no chunks."""
+
+        if max_lines == 0 or os.path.getsize(file) <= start:
+            return
+        with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield from _chunkify(mapped, self.chunk_size, max_lines, start)
 
-    def _process_wrapper(self, chunkStart, chunkSize, file, encoding, func):
-        with open(file, encoding=encoding) as f:
-            f.seek(chunkStart)
-            lines = f.read(chunkSize).splitlines()
-            self.n_lines += len(lines)
-            for n, line in enumerate(lines):
-                line = line.rstrip('\n')
+    def batches(self, file, encoding='utf-8', max_lines=None, start=0):
+        """Yields the lines of a file in batches, one list of lines per chunk.
+
+        Args:
+            file: A path to the file to read.
+            max_lines: If set, exactly the first max_lines lines of the file (from start) are read.
+            start: The byte offset to start reading at. Must be the start of a line."""
+
+        self.offset = start
+        if max_lines == 0 or os.path.getsize(file) <= start:
+            return
+        with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for chunkStart, chunkEnd in _chunkify(mapped, self.chunk_size, max_lines, start):
+                lines = _split_lines(mapped, chunkStart, chunkEnd, encoding)
+                self.n_lines += len(lines)
+                self.offset = chunkEnd
+                instrumentation.count('lines', len(lines))
+                instrumentation.progress('lines', self.n_lines, max_lines)
+                yield lines
+
+    def process(self, file, func, encoding='utf-8', max_lines=None, start=0):
+        """Calls func with each line of the file (without its newline), see batches()."""
+
+        for lines in self.batches(file, encoding, max_lines, start):
+            for line in lines:
                 func(line)
-                if n == len(lines) - 3:
-                    breakpoint
-
-    def _chunkify(self, file, encoding, size=1024*1024):
-        fileEnd = os.path.getsize(file)
-        with open(file, 'rb') as f:
-            chunkEnd = f.tell()
-            while True:
-                chunkStart = chunkEnd
-                f.seek(size, 1)
-                f.readline()
-                chunkEnd = f.tell()
-                yield chunkStart, chunkEnd - chunkStart
-                if chunkEnd > fileEnd:
-                    break
-
-    def process(self, file, func, encoding='utf-8', max_lines=None):
-        for chunkStart, chunkSize in self._chunkify(file, encoding):
-            self._process_wrapper(chunkStart, chunkSize, file, encoding, func)
-            
-            if max_lines:
-                print(f'{round((self.n_lines / max_lines)*100, 2)}% processat, ({self.n_lines} utav {max_lines} antal rader)')
+
+    def process_parallel(self, file, func, encoding='utf-8', max_lines=None, workers=None, start=0, chunks_per_task=1):
+        """Hands the chunks of the file to a pool of worker processes.
+
+        The chunks are handed out in tasks of chunks_per_task consecutive chunks. Unlike process(), func is called
+        once per task with an iterable of the lines of its chunks, and must be picklable (a module level function
+        or a functools.partial of one). A task of several chunks gives one result for all of them, so the
+        caller has fewer and larger results to reduce, e.g. one set of counts per task instead of per chunk.
+        The results are yielded in the same order as the chunks appear in the file,
+        so the caller can reduce them deterministically.
+
+        Args:
+            file: A path to the file to process.
+            func: The function applied to the lines of each chunk in the workers.
+            max_lines: If set, exactly the first max_lines lines of the file (from start) are processed.
+            workers: The number of worker processes. Defaults to the number of cores.
+            start: The byte offset to start reading at. Must be the start of a line.
+            chunks_per_task: The number of consecutive chunks read by a worker for one call of func."""
+
+        self.offset = start
+        chunks = self._chunks(file, max_lines, start)
+        tasks = ((task, file, encoding, func) for task in iter(lambda: list(islice(chunks, chunks_per_task)), []))
+        with Pool(workers) as pool:
+            for chunkEnd, n_lines, result in pool.imap(_read_chunks, tasks):
+                self.n_lines += n_lines
+                self.offset = chunkEnd
+                instrumentation.count('lines', n_lines)
+                instrumentation.progress('lines', self.n_lines, max_lines)
+                yield result
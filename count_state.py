@@ -0,0 +1,180 @@
+"""
+Module for saving and loading the counts and estimation state of an Ngrams object.
+
+The state is what Ngrams.update() needs to add a new slice of the corpus to a model:
+the vocabulary, the frequencies of all ngrams, their probabilities and continuation probabilities,
+the backoff weights, and the counts of counts, discounts and vocabulary size of the last estimation.
+Everything else (e.g. the continuation counts) is derived from the frequencies when the state is loaded.
+
+Layout of the file (arrays are in native byte order):
+    header:       magic, version, byte order, n, vocabulary size, the vocabulary size and
+                  discounts of the last estimation, the counts of counts and the probability of unknown words.
+    vocabulary:   the length of each word, followed by the UTF-8 encoded words.
+    each order k: the number of ngrams, their word IDs (k per ngram), frequencies, logged probabilities,
+                  and for k < n their continuation probabilities and logged backoff weights (NaN if none).
+
+A checkpoint of a build (see BuildModel.build_cache()) is the same state behind a header of its own,
+with the last stage that was done, the highest order estimated, and how far into the corpus the counting got.
+Values that are not estimated yet are left out: a checkpoint of order k only has the probabilities and
+continuation probabilities of the orders up to k, and only the checkpoint of the 'estimated' stage has backoff weights.
+The checkpoint is written to a temporary file which then replaces the old one, so a crash while writing it
+leaves the last checkpoint as it was.
+"""
+
+import math
+import os
+import struct
+import sys
+from array import array
+from ngrams import Ngrams
+
+MAGIC = b'NGRAMST\x00'
+VERSION = 1
+_HEADER = struct.Struct('=8sIB3xIQQ4d4Qd')
+_BYTE_ORDERS = {'little': 0, 'big': 1}
+CHECKPOINT_MAGIC = b'NGRAMCP\x00'
+_CHECKPOINT_HEADER = struct.Struct('=8sIB3x16sIQQ')
+
+
+def save_state(ngrams, state_file):
+    """Saves the counts and estimation state of an estimated Ngrams object.
+
+    The Ngrams object must have been built with build_model(keep_state=True)."""
+
+    with open(state_file, 'wb') as fhand:
+        _write_state(ngrams, fhand, ngrams.n)
+
+
+def save_checkpoint(ngrams, checkpoint_file, stage, order=0, offset=0, n_lines=0):
+    """Saves a checkpoint of a build, see the module docstring.
+
+    Args:
+        ngrams: The Ngrams object being built.
+        checkpoint_file: A path to the checkpoint file.
+        stage: The last stage done: 'counting' (the corpus is counted up to offset), 'counted', 'discounts',
+               'estimation' (the orders up to order are estimated) or 'estimated'.
+        order: The highest order whose probabilities are estimated.
+        offset: The byte offset in the corpus file that the counting got to.
+        n_lines: The number of lines counted."""
+
+    temporary_file = checkpoint_file + '.tmp'
+    with open(temporary_file, 'wb') as fhand:
+        fhand.write(_CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, VERSION, _BYTE_ORDERS[sys.byteorder],
+                                            stage.encode('ascii'), order, offset, n_lines))
+        _write_state(ngrams, fhand, order)
+    os.replace(temporary_file, checkpoint_file)
+
+
+def _write_state(ngrams, fhand, estimated):
+    """Writes the state of an Ngrams object, with the values of the orders up to estimated."""
+
+    n = ngrams.n
+    D = [ngrams.D[bucket] for bucket in range(4)] if ngrams.D else [math.nan] * 4
+    words = [word.encode('utf-8') for word in ngrams.vocab.id2word]
+
+    fhand.write(_HEADER.pack(MAGIC, VERSION, _BYTE_ORDERS[sys.byteorder], n, len(words),
+                             ngrams.vocab_size or 0, *D, *(ngrams.counts_of_counts or [0] * 4),
+                             math.nan if ngrams.unk_prob is None else ngrams.unk_prob))
+    array('I', [len(word) for word in words]).tofile(fhand)
+    fhand.write(b''.join(words))
+
+    for order in range(1, n+1):
+        freqs = ngrams.ngram_lists[order]
+        fhand.write(struct.pack('=Q', len(freqs)))
+        ids = array('I')
+        for ngram in freqs:
+            ids.extend(ngram)
+        ids.tofile(fhand)
+        array('Q', freqs.values()).tofile(fhand)
+        if order <= estimated:
+            array('d', [ngrams.probs[ngram] for ngram in freqs]).tofile(fhand)
+        if order < n and order <= estimated:
+            array('d', [ngrams.continuation_probs[ngram] for ngram in freqs]).tofile(fhand)
+        if order < n and estimated == n:
+            array('d', [ngrams.backoffs.get(ngram, math.nan) for ngram in freqs]).tofile(fhand)
+
+
+def load_state(state_file):
+    """Loads a state saved by save_state() into a new Ngrams object, which can be updated with Ngrams.update().
+
+    Raises:
+        ValueError: If the file is not a state file written on a machine with the same byte order."""
+
+    with open(state_file, 'rb') as fhand:
+        ngrams = _read_state(fhand, state_file, None)
+
+    ngrams._count_types()
+    return ngrams
+
+
+def load_checkpoint(checkpoint_file):
+    """Loads a checkpoint saved by save_checkpoint() into a new Ngrams object.
+
+    Returns:
+        A tuple of the Ngrams object and a tuple (stage, order, offset, n_lines), see save_checkpoint().
+
+    Raises:
+        ValueError: If the file is not a checkpoint written on a machine with the same byte order."""
+
+    with open(checkpoint_file, 'rb') as fhand:
+        header = fhand.read(_CHECKPOINT_HEADER.size)
+        magic, version, byte_order, stage, order, offset, n_lines = _CHECKPOINT_HEADER.unpack(header)
+        if magic != CHECKPOINT_MAGIC or version != VERSION:
+            raise ValueError(f'{checkpoint_file} is not a checkpoint of version {VERSION}.')
+        if byte_order != _BYTE_ORDERS[sys.byteorder]:
+            raise ValueError(f'{checkpoint_file} was written with another byte order.')
+        ngrams = _read_state(fhand, checkpoint_file, order)
+    return ngrams, (stage.rstrip(b'\x00').decode('ascii'), order, offset, n_lines)
+
+
+def _read_state(fhand, file, estimated):
+    """Reads a state written by _write_state() into a new Ngrams object. estimated is None for a whole state."""
+
+    header = fhand.read(_HEADER.size)
+    magic, version, byte_order, n, n_words, vocab_size, *rest = _HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{file} is not a state file of version {VERSION}.')
+    if byte_order != _BYTE_ORDERS[sys.byteorder]:
+        raise ValueError(f'{file} was written with another byte order.')
+    if estimated is None:
+        estimated = n
+
+    ngrams = Ngrams(n)
+    if vocab_size:
+        ngrams.vocab_size = vocab_size
+        ngrams.D = dict(enumerate(rest[:4]))
+        ngrams.counts_of_counts = list(rest[4:8])
+    if not math.isnan(rest[8]):
+        ngrams.unk_prob = rest[8]
+
+    lengths = _read_array(fhand, 'I', n_words)
+    blob = fhand.read(sum(lengths))
+    position = 0
+    for length in lengths:
+        ngrams.vocab.add(blob[position:position + length].decode('utf-8'))
+        position += length
+
+    for order in range(1, n+1):
+        (count,) = struct.unpack('=Q', fhand.read(8))
+        ids = _read_array(fhand, 'I', count * order)
+        freqs = _read_array(fhand, 'Q', count)
+        probs = _read_array(fhand, 'd', count) if order <= estimated else None
+        continuation_probs = _read_array(fhand, 'd', count) if order < n and order <= estimated else None
+        backoffs = _read_array(fhand, 'd', count) if order < n and estimated == n else None
+
+        for i in range(count):
+            ngram = tuple(ids[i*order:(i+1)*order])
+            ngrams._count_ngram(ngram, order, freqs[i])
+            if probs is not None:
+                ngrams.probs[ngram] = probs[i]
+            if continuation_probs is not None:
+                ngrams.continuation_probs[ngram] = continuation_probs[i]
+            if backoffs is not None and not math.isnan(backoffs[i]):
+                ngrams.backoffs[ngram] = backoffs[i]
+    return ngrams
+
+
+def _read_array(fhand, typecode, length):
+    values = array(typecode)
+    values.fromfile(fhand, length)
+    return values
@@ -0,0 +1,201 @@
+"""
+Module for generating sentences with a binary ngram model, with beam search or by sampling.
+
+The context of a sentence is kept as a tuple of the word IDs of its last n-1 words, which is rolled one word
+forward for every generated word. The next words of a context come from the longest ending of the context
+that the model has seen. If it has seen fewer words after it than asked for, the generation backs off
+to the context without its first word, adding the backoff weight of the context, like BinaryModel.logprob().
+
+The next words of each context are kept in an LRU cache shared by all prompts, so generating many sentences
+at once (or many times from the same Generator) only looks up each context once.
+"""
+
+import math
+import random
+from functools import lru_cache
+from vocabulary import Vocabulary
+
+
+def detokenize(words):
+    """Joins generated words to a sentence, without a space before punctuation."""
+
+    sentence = ''
+    for n, word in enumerate(words):
+        if word in '.,;:' or n == 0:
+            sentence += word
+        else:
+            sentence += ' ' + word
+    return sentence
+
+
+class Generator:
+    """Generates sentences from prompts with a BinaryModel."""
+
+    def __init__(self, model, seed=None, cache_size=100000, max_candidates=1000):
+        """Inits Generator.
+
+        Args:
+            model: A BinaryModel.
+            seed: The seed of the random number generator used for sampling.
+            cache_size: The number of contexts whose next words are kept in the cache.
+            max_candidates: The most words a context is sampled from with nucleus sampling.
+
+        self.rng = The random.Random used for sampling."""
+
+        self.model = model
+        self.rng = random.Random(seed)
+        self.max_candidates = max_candidates
+        self._start, self._end = model.encode((Vocabulary.START, Vocabulary.END))
+        self._skipped = {model.encode((Vocabulary.UNK,))[0], self._start}
+        self.next_words = lru_cache(maxsize=cache_size)(self._next_words)
+        self._nucleus = lru_cache(maxsize=cache_size)(self._nucleus_uncached)
+
+    def context(self, prompt):
+        """Gets the context of a prompt: the word IDs of its last n-1 words, padded with the start of a sentence.
+
+        Args:
+            prompt: A string of words separated by whitespace, or a sequence of words."""
+
+        words = prompt.split() if isinstance(prompt, str) else prompt
+        n = self.model.n
+        ids = (self._start,) * (n-1) + self.model.encode([word.lower() for word in words])
+        return ids[len(ids) - (n-1):]
+
+    def _roll(self, context, word_id):
+        return context[1:] + (word_id,) if context else context
+
+    def _candidates(self, context):
+        """Yields the next words of a context with their logged probabilities, see the module docstring.
+
+        The words seen after the longest seen ending of the context come first, most probable first,
+        then the words only seen after shorter endings. The start of a sentence and unknown words are skipped."""
+
+        seen = set(self._skipped)
+        backoff = 0.0
+        while True:
+            for word_id, logprob in self.model.ranked(context):
+                if word_id not in seen:
+                    seen.add(word_id)
+                    yield word_id, backoff + logprob
+            if not context:
+                return
+            index = self.model.find(context)
+            if index is not None:
+                backoff += self.model.backoffs[len(context)][index]
+            context = context[1:]
+
+    def _next_words(self, context, k):
+        """Gets the k most probable next words of a context as a tuple of (word ID, logged probability) tuples.
+
+        Is called through the cache as next_words(context, k)."""
+
+        top = []
+        for candidate in self._candidates(context):
+            top.append(candidate)
+            if len(top) == k:
+                break
+        top.sort(key=lambda candidate: -candidate[1])
+        return tuple(top)
+
+    def _nucleus_uncached(self, context, p):
+        """Gets the most probable next words of a context whose probabilities sum to at least p (at most max_candidates)."""
+
+        nucleus = []
+        mass = 0.0
+        for word_id, logprob in self._candidates(context):
+            nucleus.append((word_id, logprob))
+            mass += math.exp(logprob)
+            if mass >= p or len(nucleus) == self.max_candidates:
+                break
+        return tuple(nucleus)
+
+    def beam_search(self, prompts, width=5, max_length=50):
+        """Generates the most probable sentence after each prompt with beam search.
+
+        For every prompt, the width most probable sentences so far are kept. Each step they are extended
+        with their width most probable next words, and the width most probable of the new sentences are kept.
+        A sentence is finished when the end of a sentence is generated or it reaches max_length words.
+        Of the finished sentences, the one with the highest mean logged probability per word is returned,
+        so that longer sentences are not punished for having more words. Width 1 is greedy decoding.
+
+        Args:
+            prompts: A list of prompts, see context().
+            width: The number of sentences kept for each prompt.
+            max_length: The most words of a sentence, the prompt included.
+
+        Returns:
+            A list with the generated sentence of each prompt as a list of words, the prompt included."""
+
+        return [self._beam_search(prompt, width, max_length) for prompt in prompts]
+
+    def _beam_search(self, prompt, width, max_length):
+        words = prompt.split() if isinstance(prompt, str) else list(prompt)
+        beams = [(0.0, self.context(words), ())]
+        finished = []
+        while beams:
+            extended = []
+            for logprob, context, generated in beams:
+                for word_id, word_logprob in self.next_words(context, width):
+                    extended.append((logprob + word_logprob, self._roll(context, word_id), generated + (word_id,)))
+            extended.sort(key=lambda beam: -beam[0])
+
+            beams = []
+            for beam in extended[:width]:
+                logprob, _, generated = beam
+                if generated[-1] == self._end or len(words) + len(generated) >= max_length:
+                    finished.append((logprob / len(generated), generated))
+                else:
+                    beams.append(beam)
+            if len(finished) >= width:
+                break
+
+        if not finished:
+            return words
+        _, generated = max(finished, key=lambda beam: beam[0])
+        return words + [self.model.word(word_id) for word_id in generated if word_id != self._end]
+
+    def sample(self, prompts, k=None, p=None, temperature=1.0, max_length=50, seed=None):
+        """Generates a sentence after each prompt by sampling the next words.
+
+        The next word is sampled from the k most probable next words (top-k sampling), or from the most
+        probable next words whose probabilities sum to at least p (nucleus sampling), or from both if both are given.
+        The probabilities of the words are renormalized to sum to 1 and raised to 1/temperature first,
+        so a temperature below 1 makes the more probable words more likely still.
+
+        Args:
+            prompts: A list of prompts, see context().
+            k: The number of words to sample from. Defaults to 40 if p is not given.
+            p: The probability mass to sample from.
+            temperature: The temperature of the distribution.
+            max_length: The most words of a sentence, the prompt included.
+            seed: If given, the words are sampled with a new random number generator with this seed
+                  instead of self.rng, so the same call gives the same sentences.
+
+        Returns:
+            A list with the generated sentence of each prompt as a list of words, the prompt included."""
+
+        if k is None and p is None:
+            k = 40
+        rng = self.rng if seed is None else random.Random(seed)
+        sentences = []
+        for prompt in prompts:
+            words = prompt.split() if isinstance(prompt, str) else list(prompt)
+            context = self.context(words)
+            while len(words) < max_length:
+                candidates = self._nucleus(context, p) if p is not None else self.next_words(context, k)
+                if k is not None and p is not None:
+                    candidates = sorted(candidates, key=lambda candidate: -candidate[1])[:k]
+                if not candidates:
+                    break
+                word_id = self._choose(candidates, temperature, rng)
+                if word_id == self._end:
+                    break
+                words.append(self.model.word(word_id))
+                context = self._roll(context, word_id)
+            sentences.append(words)
+        return sentences
+
+    def _choose(self, candidates, temperature, rng):
+        highest = max(logprob for _, logprob in candidates)
+        weights = [math.exp((logprob - highest) / temperature) for _, logprob in candidates]
+        return rng.choices([word_id for word_id, _ in candidates], weights=weights)[0]
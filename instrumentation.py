@@ -0,0 +1,248 @@
+"""
+Module for instrumenting the build of a model: stages, counters, progress and memory.
+
+The code being measured calls the module functions:
+    - stage(name):            a context manager timing a stage of the build, e.g. the counting or the estimation.
+    - count(name, n):         adds n to a counter, e.g. the number of lines or ngrams handled.
+    - progress(name, done):   reports how far a stage has come. Reports closer than the interval apart are dropped,
+                              so it can be called often without writing to the console each time.
+    - message(text):          reports a message.
+
+These are handed as events (dicts) to the sinks of the active Instrumentation, see configure().
+When a stage ends, its event has how long it took, how much each counter grew and per second,
+and the peak resident set size of the process so far. Optionally the stage can also be profiled
+with cProfile and the peak memory it allocated traced with tracemalloc.
+
+By default the events are printed to the console. After disable(), the functions return at once
+without doing anything, so instrumented code costs almost nothing.
+Counters should be added to in bulk (per chunk, order or batch) rather than per item in an inner loop.
+"""
+
+import contextlib
+import cProfile
+import logging
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+
+def console_sink(event):
+    """Prints an event to the console."""
+
+    kind = event['event']
+    if kind == 'message':
+        print(event['text'])
+    elif kind == 'start':
+        print(f'Börjar med {event["stage"]}...')
+    elif kind == 'progress':
+        total = event.get('total')
+        if total:
+            print(f'{event["stage"]}: {round((event["done"] / total)*100, 2)}% processat, '
+                  f'({event["done"]} utav {total})')
+        else:
+            print(f'{event["stage"]}: {event["done"]} processat')
+    elif kind == 'end':
+        rates = ', '.join(f'{round(rate)} {name}/s' for name, rate in event['rates'].items())
+        print(f'{event["stage"]} klar på {round(event["seconds"], 2)} s'
+              + (f', {rates}' if rates else '') + f', max RSS {round(event["max_rss_mb"])} MB')
+
+
+def logging_sink(logger=None, level=logging.INFO):
+    """Gets a sink that logs the events with a logger of the logging module.
+
+    Args:
+        logger: The logger to use. Defaults to the logger of this module."""
+
+    logger = logger or logging.getLogger(__name__)
+
+    def sink(event):
+        logger.log(level, '%s', event)
+    return sink
+
+
+class Instrumentation:
+    """Collects the stages, counters and progress of a build and hands them to sinks."""
+
+    def __init__(self, sinks=(console_sink,), interval=1.0, trace_memory=False, profile_dir=None, profile_stages=None):
+        """Inits Instrumentation.
+
+        Args:
+            sinks: Callables that are called with each event.
+            interval: The least number of seconds between two progress events of the same stage.
+            trace_memory: Whether the peak memory allocated in each stage is traced with tracemalloc.
+                          Slows down the stages that allocate a lot.
+            profile_dir: If set, the stages are profiled with cProfile and the stats are written
+                         to <profile_dir>/<stage>.prof. Nested stages are profiled as part of the outermost.
+            profile_stages: The names of the stages to profile. Defaults to all.
+
+        self.counters = A dict with the totals of all counters.
+        self.stages = A list of the end events of all stages, in the order they ended."""
+
+        self.sinks = list(sinks)
+        self.interval = interval
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.profile_stages = profile_stages
+        self.counters = dict()
+        self.stages = []
+        self._last_progress = dict()
+        self._peaks = []
+        self._profiler = None
+
+    def emit(self, event):
+        for sink in self.sinks:
+            sink(event)
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        """Times the code run in the with block as a stage, see the module docstring."""
+
+        self.emit({'event': 'start', 'stage': name, **info})
+        counters = dict(self.counters)
+        profiler = self._start_profile(name)
+        self._start_trace()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            event = {'event': 'end', 'stage': name, **info, 'seconds': seconds}
+            grown = {key: value - counters.get(key, 0) for key, value in self.counters.items()
+                     if value != counters.get(key, 0)}
+            event['counters'] = grown
+            event['rates'] = {key: value / seconds for key, value in grown.items()} if seconds > 0 else dict()
+            event['max_rss_mb'] = max_rss_mb()
+            if self.trace_memory:
+                event['peak_traced_mb'] = self._stop_trace() / 1024**2
+            if profiler is not None:
+                event['profile'] = self._stop_profile(name)
+            self.stages.append(event)
+            self.emit(event)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def progress(self, name, done, total=None):
+        now = time.monotonic()
+        if now - self._last_progress.get(name, -self.interval) < self.interval:
+            return
+        self._last_progress[name] = now
+        self.emit({'event': 'progress', 'stage': name, 'done': done, 'total': total})
+
+    def message(self, text):
+        self.emit({'event': 'message', 'text': text})
+
+    def _start_trace(self):
+        """Starts tracing a stage's memory. The stack holds the highest peak seen so far by each enclosing stage,
+        since tracemalloc only has one peak, which is reset when a stage starts."""
+
+        if not self.trace_memory:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        self._peaks.append(0)
+
+    def _stop_trace(self):
+        peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], peak)
+        else:
+            tracemalloc.stop()
+        return peak
+
+    def _start_profile(self, name):
+        if self.profile_dir is None or self._profiler is not None:
+            return None
+        if self.profile_stages is not None and name not in self.profile_stages:
+            return None
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+        return self._profiler
+
+    def _stop_profile(self, name):
+        self._profiler.disable()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f'{name}.prof')
+        self._profiler.dump_stats(path)
+        self._profiler = None
+        return path
+
+
+class _Disabled:
+    """Instrumentation that does nothing, used after disable()."""
+
+    counters = dict()
+    stages = []
+    _stage = contextlib.nullcontext()
+
+    def stage(self, name, **info):
+        return self._stage
+
+    def count(self, name, n=1):
+        pass
+
+    def progress(self, name, done, total=None):
+        pass
+
+    def message(self, text):
+        pass
+
+
+_active = Instrumentation()
+
+
+def configure(*sinks, **options):
+    """Makes a new Instrumentation with the given sinks and options the active one and returns it.
+
+    Without sinks, the events are printed to the console. See Instrumentation for the options."""
+
+    global _active
+    _active = Instrumentation(sinks or (console_sink,), **options)
+    return _active
+
+
+def disable():
+    """Turns the instrumentation off."""
+
+    use(_Disabled())
+
+
+def use(instance):
+    """Makes an instrumentation (e.g. one returned by current() earlier) the active one."""
+
+    global _active
+    _active = instance
+
+
+def current():
+    """Gets the active Instrumentation."""
+
+    return _active
+
+
+def stage(name, **info):
+    return _active.stage(name, **info)
+
+
+def count(name, n=1):
+    _active.count(name, n)
+
+
+def progress(name, done, total=None):
+    _active.progress(name, done, total)
+
+
+def message(text):
+    _active.message(text)
+
+
+def max_rss_mb():
+    """Gets the peak resident set size of the process so far, in megabytes."""
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024**2 if sys.platform == 'darwin' else max_rss / 1024
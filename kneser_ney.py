@@ -7,14 +7,56 @@ NOTE: Since the workings of the Kneser-Ney smoothing is quite complex I won't tr
       All comments are made with the assumption that the reader understands how Kneser-Ney works.
 """
 
+from collections import defaultdict
+import instrumentation
+
+
+def counts_of_counts(ngram_freqs):
+    """Gets the number of ngrams with the counts 1, 2, 3 and 4, as a list [n_1, n_2, n_3, n_4]."""
+
+    n = [0, 0, 0, 0]
+    for freq in ngram_freqs.values():
+        if 1 <= freq <= 4:
+            n[freq-1] += 1
+    return n
+
+
+def discounts(n):
+    """Gets the value of d.
+
+    According to the modified Kneser-Ney smoothing (Chen, 1999),
+    d should be set to different values depending on if the ngram has a count of 0, 1, 2 or, 3 or more.
+    This function gets these different values and puts them in a dict so that it can easily be accessible.
+
+    I am assume that n_3 and n_4 should be the number of ngrams with counts 3 and 4 respectively,
+    but as they are not explicitly defined in the paper I am not 100% that this correct.
+
+    Args:
+        n: The counts of counts [n_1, n_2, n_3, n_4], see counts_of_counts()."""
+
+    n_1, n_2, n_3, n_4 = n
+    Y = n_1 / (n_1 + 2*n_2)
+    D = dict()
+    D[0] = 0
+    D[1] = 1 - 2 * Y * (n_2 / n_1)
+    D[2] = 2 - 3 * Y * (n_3 / n_2)
+    D[3] = 3 - 4 * Y * (n_4 / n_3)
+    return D
+
+
 class KneserNey:
 
     def __init__(self, ngram_freqs, ngram_lists, no_final_word_counts, continuation_counts, 
-                 continuation_counts_lower_ngram_strings, succeeding_counts, no_first_word):
+                 continuation_counts_lower_ngram_strings, succeeding_counts, no_first_word,
+                 D=None, vocab_size=None):
         """Inits KneserNey with a bunch of class fields. Most class fields are explained in ngrams.py.
 
+        D and vocab_size can be given to use the discounts and vocabulary size of an earlier estimation
+        instead of getting them from the counts, see update().
+
         self._highest_order = The highest order of the ngram processed.
         self._D = A dictionary containing the various d constants. Which one is used depends on the frequency of the ngram.
+        self._vocab_size = The number of word types the uniform probability of the unigrams is based on.
         self._d = The current d constant used for the ngram.
         self._ngram = The ngram currently being processed.
         """
@@ -23,7 +65,8 @@ class KneserNey:
         self._highest_order = None
         self._ngram = None
         self._ngram_lists = ngram_lists
-        self._D = self._get_D()
+        self._D = D if D is not None else self._get_D()
+        self._vocab_size = vocab_size if vocab_size is not None else len(ngram_lists[1])
         self._d = None
         self._no_final_word_counts = no_final_word_counts
         self._continuation_counts = continuation_counts
@@ -41,16 +84,221 @@ class KneserNey:
         self._ngram = ngram
 
         if train:
+            instrumentation.count('recursions', len(self._ngram))  # _P_KN() recurses once per order, down to the unigram.
             return self._P_KN(self._ngram)
 
         elif get_prob:
             ngrams = self._no_first_word[len(self._ngram)][self._ngram[1:]]
             if len(ngrams) != 0:
+                instrumentation.count('recursions', len(ngrams) * len(self._ngram))
                 P_KN = max([self._P_KN(ngram) for ngram in ngrams])  # Undrar hur det skulle vara om man returnerade snittet?
                 return P_KN
             else:
                 return self.kneser_ney(self._ngram[1:])
 
+    def estimate(self, continuation_probs=None, start=1):
+        """Calculates the Kneser-Ney smoothed probabilities of all ngrams, one order at a time.
+
+        Gives the same probabilities as calling kneser_ney(ngram, train=True) on every ngram,
+        but instead of recursing down through the lower orders for every ngram,
+        the orders are estimated bottom-up, starting with the unigrams.
+        The continuation probabilities of order k are kept until order k+1 is done,
+        so each lower order probability is calculated once instead of once per ngram it is a suffix of.
+        The counts that only depend on the string (the ngram without the final word) are
+        also calculated once per string, see _string_terms().
+
+        Is a generator yielding (order, probs) where probs is a dict with the probabilities
+        of all ngrams of that order, so the caller can handle each order when it is done.
+
+        Args:
+            continuation_probs: If a dict is given, the continuation probabilities of all orders
+                                but the highest are kept in it, so that update() can use them later.
+            start: The lowest order to estimate, to resume an estimation where the orders below are done.
+                   continuation_probs must then hold the continuation probabilities of the order below."""
+
+        highest_order = max(self._ngram_lists)
+
+        if start <= 1:
+            lower_probs = self._estimate_unigrams(self._ngram_lists[1])
+            if continuation_probs is not None:
+                continuation_probs.update(lower_probs)
+            yield 1, lower_probs
+        else:
+            lower_probs = continuation_probs
+
+        for order in range(max(start, 2), highest_order + 1):
+            ngrams = self._ngram_lists[order]
+            strings = self._string_terms(order)
+            instrumentation.count('strings', len(strings))
+            probs, order_continuation_probs = self._estimate_ngrams(
+                order, ngrams, strings, lower_probs, order < highest_order)
+            if continuation_probs is not None:
+                continuation_probs.update(order_continuation_probs)
+            yield order, probs
+
+            lower_probs = order_continuation_probs
+
+    def update(self, changed, new_types, continuation_probs):
+        """Re-estimates only the ngrams whose probabilities can have changed after new counts were added.
+
+        The discounts and the vocabulary size are taken as they are (see __init__), so the ngrams whose
+        probabilities can change are the ones where one of the terms of the formula has changed:
+            - the ngram's own frequency, or its continuation count because a new ngram of the order above ends with it,
+            - a term of its string: the frequencies of the ngrams the string is prefix of, the frequency of the string,
+              the number of word types succeeding it or its continuation count,
+            - the continuation probability of the ngram without its first word.
+        Going bottom-up, the ngrams re-estimated at order k are the ones whose continuation probabilities
+        can have changed for order k+1.
+        The ngrams of a string are looked up in no_final_word_counts and the ngrams of an ngram without its first word
+        in no_first_word, so the work done depends on the number of changed strings and not on the size of the model.
+
+        Is a generator yielding (order, probs) like estimate(), but probs only has the re-estimated ngrams.
+
+        Args:
+            changed: A dict with the order as key and the set of ngrams whose frequencies have changed as value.
+            new_types: A dict with the order as key and the set of ngrams that had not been seen before as value.
+            continuation_probs: The continuation probabilities from the earlier estimation, see estimate().
+                                They are updated with the re-estimated ngrams."""
+
+        highest_order = max(self._ngram_lists)
+
+        probs = self._estimate_unigrams(changed.get(1, ()))
+        continuation_probs.update(probs)
+        yield 1, probs
+
+        dirty_lower = set(probs)
+        for order in range(2, highest_order + 1):
+            new_above = new_types.get(order + 1, ())
+            strings = {ngram[:-1] for ngram in changed.get(order, ())}
+            strings.update(changed.get(order - 1, ()))
+            strings.update(ngram[-(order-1):] for ngram in new_above)
+
+            dirty = set(changed.get(order, ()))
+            dirty.update(ngram[1:] for ngram in new_above)
+            for string in strings:
+                dirty.update(self._no_final_word_counts.get(string, ()))
+            suffixes = self._no_first_word[order]
+            for ngram in dirty_lower:
+                dirty.update(suffixes.get(ngram, ()))
+
+            terms = self._string_terms(order, {ngram[:-1] for ngram in dirty})
+            instrumentation.count('strings', len(terms))
+            probs, order_continuation_probs = self._estimate_ngrams(
+                order, dirty, terms, continuation_probs, order < highest_order)
+            continuation_probs.update(order_continuation_probs)
+            yield order, probs
+
+            dirty_lower = dirty
+
+    def _estimate_unigrams(self, ngrams):
+        """Calculates the probabilities of the given unigrams, which are also their continuation probabilities."""
+
+        freqs = self._ngram_lists[1]
+        continuation_prob = 1 / self._vocab_size
+
+        probs = dict()
+        for ngram in ngrams:
+            d = self._D[min(freqs[ngram], 3)]
+            probs[ngram] = max(1 - d, 0) + d * continuation_prob
+        return probs
+
+    def _estimate_ngrams(self, order, ngrams, strings, lower_probs, estimate_continuations):
+        """Calculates the probabilities of the given ngrams of an order > 1.
+
+        Args:
+            strings: The terms of the strings of the ngrams, see _string_terms().
+            lower_probs: The continuation probabilities of the ngrams of the order below.
+            estimate_continuations: Whether the continuation probabilities should also be calculated.
+
+        Returns:
+            A tuple of two dicts: the probabilities and the continuation probabilities of the ngrams."""
+
+        freqs = self._ngram_lists[order]
+        continuations = self._continuation_counts[order]
+
+        probs = dict()
+        continuation_probs = dict()
+        for ngram in ngrams:
+            freq = freqs[ngram]
+            bucket = min(freq, 3)
+            d = self._D[bucket]
+            c_KN_string, continuation_c_KN_string, lambdas = strings[ngram[:-1]]
+            backoff = lambdas[bucket] * lower_probs[ngram[1:]]
+            probs[ngram] = max(freq - d, 0) / c_KN_string + backoff
+            if estimate_continuations:
+                continuation_probs[ngram] = max(continuations[ngram] - d, 0) / continuation_c_KN_string + backoff
+        return probs, continuation_probs
+
+    def _string_terms(self, order, strings=None):
+        """Gets the terms of the Kneser-Ney formula that only depend on the string for the strings of an order.
+
+        Returns a dict with the string as key and a tuple of:
+            - C_KN of the string when the ngram is the highest order, i.e. the summed frequencies of all ngrams it is prefix of.
+            - C_KN of the string when the ngram is a lower order, i.e. its continuation count.
+            - The lambdas of the string, one for each value of d.
+
+        Args:
+            strings: A set of the strings to get the terms of. Defaults to all strings of the order."""
+
+        c_KN_strings = self._c_KN_strings(order, strings)
+        continuations = self._continuation_counts_lower_ngram_strings[order]
+        succeeding = self._succeeding_counts[order]
+        D = [self._D[bucket] for bucket in range(4)]
+
+        terms = dict()
+        for string, c_KN_string in c_KN_strings.items():
+            freq = self._ngram_freqs[string]
+            succeeding_count = succeeding[string]
+            lambdas = tuple([d / freq * succeeding_count for d in D])
+            terms[string] = (c_KN_string, continuations[string], lambdas)
+        return terms
+
+    def _c_KN_strings(self, order, strings=None):
+        """Gets the C_KN of the strings of an order when the ngram is the highest order.
+
+        If a set of strings is given, only the C_KN of those strings are summed."""
+
+        c_KN_strings = defaultdict(int)
+        if strings is None:
+            for ngram, freq in self._ngram_lists[order].items():
+                c_KN_strings[ngram[:-1]] += freq
+        else:
+            for string in strings:
+                ngrams = self._no_final_word_counts.get(string)
+                if ngrams:
+                    c_KN_strings[string] = sum(ngrams.values())
+        return c_KN_strings
+
+    def backoff_weights(self, strings=None):
+        """Gets the backoff weight of every string (ngram without its final word) that has been seen.
+
+        The backoff weight of a string is the probability mass that the discounts have taken
+        from the ngrams that the string is prefix of. That mass is what is left for the words
+        that have never been seen after the string, so the probability of such a word is
+        the backoff weight times the probability of the word given the shorter string.
+
+        Returns a dict with the string as key and the (not logged) backoff weight as value.
+
+        Args:
+            strings: A set of the strings to get the backoff weights of. Defaults to all strings."""
+
+        weights = defaultdict(float)
+        if strings is not None:
+            for string in strings:
+                ngrams = self._no_final_word_counts.get(string)
+                if ngrams:
+                    c_KN_string = sum(ngrams.values())
+                    for freq in ngrams.values():
+                        weights[string] += min(freq, self._D[min(freq, 3)]) / c_KN_string
+            return dict(weights)
+
+        for order in range(2, max(self._ngram_lists) + 1):
+            c_KN_strings = self._c_KN_strings(order)
+            for ngram, freq in self._ngram_lists[order].items():
+                string = ngram[:-1]
+                weights[string] += min(freq, self._D[min(freq, 3)]) / c_KN_strings[string]
+        return dict(weights)
+
     def _P_KN(self, ngram):
         """Calculates the Kneser-Ney smoothed probability given the discount, the lambda, and the continuation probability.
         
@@ -67,7 +315,7 @@ class KneserNey:
         if len(self._ngram) == 1:
             discount = self._discount()
             LAMBDA = self._lambda()
-            continuation_prob = 1 / len(self._ngram_lists[len(self._ngram)])
+            continuation_prob = 1 / self._vocab_size
             return discount + LAMBDA * continuation_prob
 
         discount = self._discount()
@@ -124,44 +372,20 @@ class KneserNey:
                 for ngram, freq in self._no_final_word_counts[string].items(): c_KN += freq 
         else:
             if string == self._ngram:
-                c_KN = len(self._continuation_counts[len(self._ngram)][string])
+                c_KN = self._continuation_counts[len(self._ngram)][string]
             else:
-                c_KN = len(self._continuation_counts_lower_ngram_strings[len(self._ngram)][string])
+                c_KN = self._continuation_counts_lower_ngram_strings[len(self._ngram)][string]
         return c_KN
 
     def _get_D(self):
-        """Gets the value of d.
-
-        According to the modified Kneser-Ney smoothing (Chen, 1999),
-        d should be set to different values depending on if the ngram has a count of 0, 1, 2 or, 3 or more.
-        This function gets these different values and puts them in a dict so that it can easily be accessible.
-
-        I am assume that n_3 and n_4 should be the number of ngrams with counts 3 and 4 respectively,
-        but as they are not explicitly defined in the paper I am not 100% that this correct."""
-
-        n_1, n_2, n_3, n_4 = 0, 0, 0, 0
-        for ngram, freq in self._ngram_freqs.items():
-            if freq == 1:
-                n_1 += 1
-            elif freq == 2:
-                n_2 += 1
-            elif freq == 3:
-                n_3 += 1
-            elif freq == 4:
-                n_4 += 1
-
-        Y = n_1 / (n_1 + 2*n_2)
-        D = dict()
-        D[0] = 0
-        D[1] = 1 - 2 * Y * (n_2 / n_1)
-        D[2] = 2 - 3 * Y * (n_3 / n_2)
-        D[3] = 3 - 4 * Y * (n_4 / n_3)
-        return D
+        """Gets the values of d from the frequencies of all ngrams, see discounts()."""
+
+        return discounts(counts_of_counts(self._ngram_freqs))
 
     def _succeeding_count(self, string):
         """Gets the number of word types succeding the string."""
 
-        return len(self._succeeding_counts[len(self._ngram)][string])
+        return self._succeeding_counts[len(self._ngram)][string]
 
     def _basecase(self):
         """Basecase for when to stop the recursion."""
@@ -176,4 +400,5 @@ class KneserNey:
         
     def _unknown_word_prob(self, ngram):
         self._ngram = ngram
+        self._d = self._D[1]  # The unknown word is discounted like a word seen once.
         return self._lambda() / len(self._ngram_freqs)
\ No newline at end of file
@@ -1,6 +1,10 @@
 from build_model import BuildModel
-import pickle
-from collections import deque
+from binary_model import BinaryModel
+from segmented_model import SegmentedModel
+from scoring import score_sentences
+from generation import Generator, detokenize
+import os
+import sys
 
 class Main:
 
@@ -9,64 +13,45 @@ class Main:
         # N:
         self.n = 5
         self.model = None
+        self.generator = None
 
-    def create_model(self, datafile, pickle_file, csv_file, pickle_ngrams=False):
+    def create_model(self, datafile, model_file, arpa_file=False, pickle_ngrams=False):
         build_model = BuildModel(self.n)
-        build_model.build_cache(file=datafile, pickle_file=pickle_file, csv_file=csv_file, 
+        build_model.build_cache(file=datafile, model_file=model_file, arpa_file=arpa_file, 
                                 pickle_ngrams=pickle_ngrams, max=466521)
 
-    def read_model(self, pickle_file):
+    def read_model(self, model_file):
+        """Opens a binary model file. The file is memory mapped, so nothing is read until it is queried.
+        
+        If model_file is a directory of segments (see segmented_model.py), only the manifest is read,
+        and the segments are opened when they are first used and warmed up in the background.
+        Models pickled by earlier versions can be converted with binary_model.convert_pickle()."""
         print('Loading model...')
-        pickle_file = pickle_file
-        with open(pickle_file, 'rb') as p:
-            self.model = pickle.load(p)
+        if os.path.isdir(model_file):
+            self.model = SegmentedModel(model_file, warm_up=True)
+        else:
+            self.model = BinaryModel(model_file)
+        self.generator = Generator(self.model)
         print('Finished.')
 
 
-    def _get_best(self, prefix, n):
-        if isinstance(prefix, str):
-            prefix = (prefix,)
-
-        best = (None, float('-inf'))
-        for ngram, prob in self.model[n][tuple(prefix)]:
-            if prob > best[1]:
-                best = (ngram, prob)
-        return best
-    
-    def generate_sentence(self, first_word, n=5):
-        generated = [first_word]
-        prefix = ['<s>']*(n-2) + [first_word.lower()]
-
-        while True:
-            best = self._get_best(prefix, n)
-            
-            if best[0] is None:
-                return 'Word not first word.\n'
-                
+    def score(self, sentences):
+        """Scores a batch of sentences with the model, see scoring.score_sentences().
+        
+        Returns the logged probabilities of the tokens of each sentence, the logged probability
+        of each sentence and the perplexity of all sentences."""
+        return score_sentences(self.model, sentences)
 
-            generated.append(best[0][-1])
-            
-            if best[0][-1] == ('</s>'):
-                break
+    def generate_sentence(self, first_word, width=1):
+        """Generates a sentence starting with first_word with beam search, see generation.Generator.
 
-            prefix.append(best[0][-1])
-            prefix = prefix[-4:]
-            
-        if generated[-1] == '</s>':
-            generated = generated[:-1]
-        
-        sentence = ''
-        for n, word in enumerate(generated):
-            if word in '.,;:' or n == 0:
-                sentence += word
-            else:
-                sentence += ' ' + word
-        return sentence
+        With width 1 the most probable next word is taken every time."""
+        return detokenize(self.generator.beam_search([first_word], width)[0])
     
 
 if __name__ == '__main__':
     main = Main()
-    main.read_model()
+    main.read_model(sys.argv[1])
 
     while True:
         word = input('Enter first word\n')
@@ -1,8 +1,43 @@
 from nltk.tokenize import word_tokenize
 from collections import defaultdict
-from collections import deque
 import math
-from kneser_ney import KneserNey
+from kneser_ney import KneserNey, counts_of_counts, discounts
+from parallel_estimation import ParallelKneserNey
+from vocabulary import Vocabulary
+import instrumentation
+
+
+def _int_dict():
+    """Factory for the nested count dicts. A named function instead of a lambda so that Ngrams can be pickled."""
+    return defaultdict(int)
+
+
+def _set_dict():
+    """Factory for the nested set dicts. A named function instead of a lambda so that Ngrams can be pickled."""
+    return defaultdict(set)
+
+
+def count_lines(lines, n):
+    """Counts the ngrams of a batch of lines.
+
+    Used as the worker function when the corpus is counted in parallel, see BuildModel.build_cache().
+    Only the frequencies per order are counted and sent back, with the words of the batch's vocabulary,
+    since that is all Ngrams.merge_counts() reads. The other tables of Ngrams hold the same counts again,
+    so they are filled in by the merge instead of being built, pickled and sent back by every worker.
+
+    Args:
+        lines: An iterable of lines, e.g. the lines of several chunks read one chunk at a time.
+        n: The highest order of the ngrams.
+
+    Returns:
+        A tuple of the words of the vocabulary in the order of their IDs, and a dict with the order as key
+        and a dict with the frequencies of the ngrams of that order as value."""
+
+    counter = _FrequencyCounter(n)
+    for line in lines:
+        counter.create_ngrams(line)
+    return counter.vocab.id2word, counter.ngram_lists
+
 
 class Ngrams:
     """Class to build an ngram model."""
@@ -12,133 +47,325 @@ class Ngrams:
         
         The fields initialized here are needed for the KneserNey class (the names here are not always the best):
 
+        self.vocab = The vocabulary mapping each word type to the integer ID used in the ngram tuples.
         self.ngram_freqs = A defaultdict containing the frequencies of all ngrams.
         self.probs = A dict containing the Kneser-Ney smoothed probabilities of all ngrams.
+        self.backoffs = A dict containing the logged backoff weights of all strings (ngrams without the final word).
+        self.unk_prob = The logged probability of an unknown word.
+        self.continuation_probs = A dict containing the continuation probabilities of all ngrams below the highest order.
+            Only kept if build_model() is asked to, since update() needs them.
+        self.counts_of_counts = The number of ngrams with the counts 1, 2, 3 and 4, which the discounts are based on.
+        self.D = The discounts used in the last estimation.
+        self.vocab_size = The vocabulary size used in the last estimation.
         self.KN = An object of the Kneser-Ney class.
         self.ngram_lists = The frequencies of all ngrams organized after length.
         self.no_final_word_counts = A nested defaultdict containing the counts of the ngrams without their final words.
         self.continuation_counts = A nested defaultdict containing counts of often an ngram is a continuation of another ngram.
         self.continuation_counts_lower_ngram_strings = A nested defaultdict containing counts of often an ngram without the last word is a continuation of another ngram.
         self.succeeding_counts = A nested defaultdict containing counts of how many final word types succeed an ngram without the final word.
-        self.prefixes = A nested defaultdict containing ngram prefixes as key, and a set of the full ngrams they are prefix of.
+            These three only hold the number of distinct types, and are filled in by _count_types() after the counting is done.
+        self.no_first_word = A nested defaultdict with, for each order, the ngrams without their first word as key
+            and a set of the full ngrams as value. Only filled in when the model is updated, see update().
         """
         self.n = n
+        self.vocab = Vocabulary()
         self.ngram_freqs = defaultdict(int)
+        self.ngram_freqs[(self.vocab.UNK_ID,)] = 0  # Handle unknown strings
         self.probs = dict()
+        self.backoffs = dict()
+        self.unk_prob = None
+        self.continuation_probs = dict()
+        self.counts_of_counts = None
+        self.D = None
+        self.vocab_size = None
         self.KN = None
-        self.ngram_lists = defaultdict(lambda: defaultdict(int))
-        self.no_final_word_counts = defaultdict(lambda: defaultdict(int))
-        self.continuation_counts = defaultdict(lambda: defaultdict(set))
-        self.continuation_counts_lower_ngram_strings = defaultdict(lambda: defaultdict(set))
-        self.succeeding_counts = defaultdict(lambda: defaultdict(set))
-        self.no_first_word = defaultdict(lambda: defaultdict(set))
-
-    def build_model(self):
-        """Driver function to create an ngram model."""
-
-        print('Börjar skapa modellen...')
-        print('Börjar med KN...')
+        self.ngram_lists = defaultdict(_int_dict)
+        self.no_final_word_counts = defaultdict(_int_dict)
+        self.continuation_counts = defaultdict(_int_dict)
+        self.continuation_counts_lower_ngram_strings = defaultdict(_int_dict)
+        self.succeeding_counts = defaultdict(_int_dict)
+        self.no_first_word = defaultdict(_set_dict)
+
+    def build_model(self, keep_state=False, checkpoint=None, resume=None, workers=None):
+        """Driver function to create an ngram model.
+        
+        If keep_state is True, the continuation probabilities are kept so that the model can be updated later, see update().
+
+        Args:
+            checkpoint: If given, a function called as checkpoint(stage, order) when the discounts are done
+                        ('discounts', 0), when each order is estimated ('estimation', order) and when the
+                        backoff weights are done ('estimated', n), see count_state.save_checkpoint().
+            resume: The (stage, order) of the checkpoint this object was loaded from, see count_state.load_checkpoint().
+                    The stages that were done before the checkpoint are skipped.
+            workers: If set, each order is estimated by this many worker processes, see parallel_estimation.py."""
+
+        done, order = resume or ('counted', 0)
+        with instrumentation.stage('types'):
+            self._count_types()
+        with instrumentation.stage('estimation'):
+            if done in ('counting', 'counted'):
+                self.counts_of_counts = counts_of_counts(self.ngram_freqs)
+                self._create_KN(discounts(self.counts_of_counts), len(self.ngram_lists[1]))
+                if checkpoint:
+                    checkpoint('discounts', 0)
+            else:
+                self._create_KN(self.D, self.vocab_size)
+            if done != 'estimated':
+                self._get_probabilities(keep_state, checkpoint, order + 1, workers)
+        with instrumentation.stage('structure'):
+            return self._structure()
+
+    def _create_KN(self, D, vocab_size):
+        self.D = D
+        self.vocab_size = vocab_size
         self.KN = KneserNey(self.ngram_freqs, self.ngram_lists, self.no_final_word_counts, 
                             self.continuation_counts, self.continuation_counts_lower_ngram_strings,
-                            self.succeeding_counts, self.no_first_word)
-        print('Tagit fram KN-objektet, börjar med sannolikheterna...')
-        self._get_probabilities()
-        print('Strukturerar...')
-        return self._structure()
+                            self.succeeding_counts, self.no_first_word, D=D, vocab_size=vocab_size)
+
+    def update(self, other, tolerance=0.01):
+        """Adds the counts of another Ngrams object to an estimated model and re-estimates what they change.
+
+        Used to add a new slice of the corpus without counting the whole corpus again:
+        the counts of the new slice are merged like in merge(), while keeping track of
+        which ngrams got new frequencies and which are new types. The counts of counts
+        are updated from the old and new frequency of each changed ngram, which gives the new discounts.
+
+        If neither the discounts nor the vocabulary size have changed by more than tolerance (relatively),
+        the old discounts and vocabulary size are kept and only the ngrams whose probabilities
+        the new counts can change are re-estimated, see KneserNey.update(). Otherwise the whole model is re-estimated.
+
+        The model must have been built with build_model(keep_state=True) or loaded with count_state.load_state().
+        The first update of a model also fills in self.no_first_word, which takes one pass over the ngrams
+        (like loading the state does). It is then kept up to date, so the updates after it do not go through all ngrams.
+
+        Returns:
+            True if only the changed ngrams were re-estimated, False if the whole model was."""
+
+        self._index_suffixes()
+        id_map = [self.vocab.add(word) for word in other.vocab.id2word]
+        changed = defaultdict(set)
+        new_types = defaultdict(set)
+        n = list(self.counts_of_counts)
+        for order in sorted(other.ngram_lists):
+            ngrams = self.ngram_lists[order]
+            for ngram, freq in other.ngram_lists[order].items():
+                ngram = tuple([id_map[i] for i in ngram])
+                old_freq = ngrams.get(ngram, 0)
+                if 1 <= old_freq <= 4:
+                    n[old_freq-1] -= 1
+                if old_freq + freq <= 4:
+                    n[old_freq+freq-1] += 1
+
+                self._count_ngram(ngram, order, freq)
+                changed[order].add(ngram)
+                if old_freq == 0:
+                    new_types[order].add(ngram)
+                    if order > 1:
+                        self._count_successions(ngram, order)
+                        self._no_first_word(ngram, order)
+                    if order > 2:
+                        self._count_continuations(ngram, order)
+        self.counts_of_counts = n
+
+        D = discounts(n)
+        vocab_size = len(self.ngram_lists[1])
+        drift = max([abs(D[bucket] - self.D[bucket]) / max(abs(self.D[bucket]), 1e-9) for bucket in range(1, 4)]
+                    + [abs(vocab_size - self.vocab_size) / max(self.vocab_size, 1)])
+        if drift > tolerance:
+            instrumentation.message(f'Diskonteringarna har ändrats med {round(drift*100, 2)}%, skattar om hela modellen...')
+            self._create_KN(D, vocab_size)
+            self.probs = dict()
+            self.backoffs = dict()
+            self.continuation_probs = dict()
+            self._get_probabilities(keep_state=True)
+            return False
+
+        self._create_KN(self.D, self.vocab_size)
+        for order, probs in self.KN.update(changed, new_types, self.continuation_probs):
+            for ngram, prob in probs.items():
+                self.probs[ngram] = math.log(prob)
+            instrumentation.count('ngrams estimated', len(probs))
+            instrumentation.message(f'{order}-grams klara, ({len(probs)} antal ngrams skattade om)')
+
+        strings = {ngram[:-1] for order in changed if order > 1 for ngram in changed[order]}
+        for string, weight in self.KN.backoff_weights(strings).items():
+            self.backoffs[string] = math.log(weight) if weight > 0 else float('-inf')
+        self.unk_prob = math.log(self.KN.kneser_ney((self.vocab.UNK_ID,)))
+        return True
 
     def create_ngrams(self, sentence):
         """Creates ngrams with length = 1,...,n from a given sentence.
         
-        Uses the helper function _add_ngrams() to create the ngrams.
+        The sentence is tokenized once and each token is mapped to its integer ID
+        in self.vocab. Then the helper function _add_ngrams() creates the ngrams
+        of all orders in one pass over the IDs.
 
         Also counts each ngram's frequency
         
         Note that the function will create ngrams of all the lower orders of n aswell.
         If n = 3, the function will create unigrams, bigrams and trigrams.
         
-        All ngrams and frequencies are saved to self.ngram_freqs.
+        All ngrams and frequencies are saved to self.ngram_freqs, with tuples of word IDs as keys.
         
         Args:
-            sentence: An untokenized sentence.
-            n: The highest order of the ngrams to be created."""
+            sentence: An untokenized sentence."""
 
-        n = self.n
-        self.ngram_freqs[tuple(['[UNK]'])] = 0  # Handle unknown strings
-        for i in range(1, n+1):
-            self._add_ngrams(sentence, n=i)
+        add = self.vocab.add
+        self._add_ngrams([add(word.lower()) for word in word_tokenize(sentence)])
 
-    def _add_ngrams(self, sentence, n):
-        """Creates ngrams from a sentence and adds them to self.ngram_freqs.
-        
-        Continuously adds words to a deque. When the length of the deque = n,
-        saves contents of deque to self.ngram_freqs and increments its frequency with 1.
-        Then pops the leftmost word of the deque and starts over.
+    def _add_ngrams(self, ids):
+        """Creates ngrams of all orders from a sentence of word IDs and adds them to self.ngram_freqs.
         
-        Also adds padding to beginning and end of sentence.
+        Each order k is counted as if the sentence was padded with k start and k end symbols,
+        which is what the ngrams would be if each order was created on its own.
+        Instead of padding the sentence once per order, it is padded once with n symbols
+        and a window is slid over it. Every window end gets the ngrams of all orders that end there,
+        except the ones that would reach further into the padding than that order's own padding does.
         
         Also adds counts to various other frequency dicts (see __init__)."""
 
-        sentence = word_tokenize(sentence)
-        start = '<s>'
-        end = '</s>'
+        n = self.n
+        length = len(ids)
+        padded = [self.vocab.START_ID] * n + ids + [self.vocab.END_ID] * n
+
+        for end in range(n, length + 2*n + 1):
+            window = tuple(padded[end-n:end])
+            for k in range(max(1, end - n - length), n+1):
+                self._count_ngram(window[n-k:], k)
+
+    def _count_ngram(self, ngram, n, count=1):
+        """Adds count to the frequency of an ngram of order n and to the other frequency dicts (see __init__)."""
+
+        self.ngram_freqs[ngram] += count
+        self.ngram_lists[n][ngram] += count
+        self.no_final_word_counts[ngram[:-1]][ngram] += count
+
+    def merge(self, other):
+        """Merges the counts of another Ngrams object into this one.
+
+        The other object has its own vocabulary, so its word IDs are first mapped to the IDs
+        of this vocabulary. Words new to this vocabulary are added in the order the other
+        vocabulary first saw them, so merging the shards of a corpus in order gives the
+        same IDs as counting the corpus serially.
+
+        Only the frequencies per order are read from the other object. The continuation
+        and succession counts only depend on which ngrams exist, so they are derived
+        from the merged ngrams by _count_types()."""
+
+        self.merge_counts(other.vocab.id2word, other.ngram_lists)
+
+    def merge_counts(self, words, ngram_lists):
+        """Merges frequencies per order counted with another vocabulary into this one, like merge().
+
+        Args:
+            words: The words of the other vocabulary in the order of their IDs.
+            ngram_lists: A dict with the order as key and a dict with the frequencies of the ngrams of that order
+                         (as tuples of IDs of the other vocabulary) as value, e.g. from count_lines()."""
+
+        id_map = [self.vocab.add(word) for word in words]
+        for order in sorted(ngram_lists):
+            for ngram, freq in ngram_lists[order].items():
+                self._count_ngram(tuple([id_map[i] for i in ngram]), order, freq)
+
+    def _get_probabilities(self, keep_state=False, checkpoint=None, start=1, workers=None):
+        """Uses the KneserNey class to get the probabilities of all ngrams.
         
-        sentence[0:0] = [start] * n
-        sentence.extend([end] * n)
-        ngram = deque()
-
-        for i in range(len(sentence)):
-            ngram.append(sentence[i].lower())
-            if len(ngram) == n:
-                self.ngram_freqs[tuple(ngram)] += 1
-                self.ngram_lists[n][tuple(ngram)] += 1
-                self.no_final_word_counts[tuple(ngram)[:-1]][tuple(ngram)] += 1
-                if n > 1:
-                    self._count_successions(tuple(ngram), n)
-                if n > 2: 
-                    self._count_continuations(tuple(ngram), n)
-                ngram.popleft()
-
-    def _get_probabilities(self):
-        """Uses the KneserNey class to get the probabilities of an ngram."""
+        The probabilities are estimated one order at a time, see KneserNey.estimate().
+        Also gets the backoff weights of all strings and the probability of an unknown word,
+        which are needed to get the probability of an ngram that has not been seen.
 
-        n = 0
-        max = len(self.ngram_freqs)
-        part = 100000
-        for ngram in self.ngram_freqs:
-            if ngram != ('[UNK]',):
-                self.KN._highest_order = len(ngram)
-                self.probs[ngram] = math.log(self.KN.kneser_ney(ngram, train=True))
-            n += 1
-            if n % part == 0:
-                print(f'{round((n / max)*100, 2)}% processat, ({n} utav {max} antal ngrams)')
+        With a checkpoint function (see build_model()), the continuation probabilities are kept until
+        the estimation is done, since a resumed estimation needs the ones of the order below.
+        The estimation then starts at order start, with the orders below taken from the checkpoint.
+        With workers, the orders are estimated by a pool of processes, see parallel_estimation.py."""
+
+        estimator = ParallelKneserNey(self.KN, workers) if workers else self.KN
+        continuation_probs = self.continuation_probs if keep_state or checkpoint else None
+        for order, probs in estimator.estimate(continuation_probs, start):
+            for ngram, prob in probs.items():
+                self.probs[ngram] = math.log(prob)
+            instrumentation.count('ngrams estimated', len(probs))
+            instrumentation.message(f'{order}-grams klara, ({len(probs)} antal ngrams)')
+            if checkpoint:
+                checkpoint('estimation', order)
+
+        for string, weight in estimator.backoff_weights().items():
+            self.backoffs[string] = math.log(weight) if weight > 0 else float('-inf')
+        self.unk_prob = math.log(self.KN.kneser_ney((self.vocab.UNK_ID,)))
+        if checkpoint:
+            checkpoint('estimated', self.n)
+            if not keep_state:
+                self.continuation_probs = dict()
+
+    def _count_types(self):
+        """Fills in the continuation and succession dicts from the counted ngrams.
+
+        These dicts count distinct types, e.g. how many different ngrams a string is a continuation of.
+        Every key of self.ngram_lists is a distinct ngram, so going through them once
+        and adding 1 per ngram gives the number of types without keeping sets of the ngrams themselves."""
+
+        self.continuation_counts = defaultdict(_int_dict)
+        self.continuation_counts_lower_ngram_strings = defaultdict(_int_dict)
+        self.succeeding_counts = defaultdict(_int_dict)
+
+        for n, ngrams in self.ngram_lists.items():
+            if n < 2:
+                continue
+            for ngram in ngrams:
+                self._count_successions(ngram, n)
+                if n > 2:
+                    self._count_continuations(ngram, n)
 
     def _count_continuations(self, ngram, n):
         """Adds counts to the continuation dicts. (see __init__ for)"""
-        self.continuation_counts[n-1][ngram[1:]].add(ngram)
-        self.continuation_counts_lower_ngram_strings[n-1][ngram[-(n-2):]].add(ngram)
+        self.continuation_counts[n-1][ngram[1:]] += 1
+        self.continuation_counts_lower_ngram_strings[n-1][ngram[-(n-2):]] += 1
                 
     def _count_successions(self, ngram, n):
         """Counts how many word types that can succeed the string: the ngram without the final word"""
-        self.succeeding_counts[n][ngram[:-1]].add(ngram[-1])
+        self.succeeding_counts[n][ngram[:-1]] += 1
 
     def _no_first_word(self, ngram, n):
         self.no_first_word[n][ngram[1:]].add(ngram)
 
+    def _index_suffixes(self):
+        """Fills in self.no_first_word from the counted ngrams, if it has not been filled in already."""
+
+        if self.no_first_word:
+            return
+        for n, ngrams in self.ngram_lists.items():
+            if n < 2:
+                continue
+            for ngram in ngrams:
+                self._no_first_word(ngram, n)
+
     def _structure(self):
-        """Puts all the ngrams with their probabilities into a dict structured after the length of the ngram."""
+        """Puts all the ngrams with their probabilities into a dict structured after the length of the ngram.
+        
+        The word IDs are converted back to words here, so the structured model is keyed by words."""
 
         structured_probs = defaultdict(lambda: defaultdict(list))
+        decode = self.vocab.decode
 
         n = 0
         max = len(self.ngram_freqs)
         part = 50000
         for ngram, prob in self.probs.items():
+            ngram = decode(ngram)
             if len(ngram) == 1:
                 structured_probs[len(ngram)][ngram[0]] = (ngram[0], prob)
             structured_probs[len(ngram)][ngram[:-1]].append((ngram, prob))
 
             n += 1
             if n % part == 0:
-                print(f'{round((n / max)*100, 2)}% processat, ({n} utav {max} antal ngrams)')
+                instrumentation.progress('structure', n, max)
+        instrumentation.count('ngrams structured', n)
 
         return dict(structured_probs), self.probs
+
+
+class _FrequencyCounter(Ngrams):
+    """Ngrams that only counts the frequencies per order, for count_lines()."""
+
+    def _count_ngram(self, ngram, n, count=1):
+        self.ngram_lists[n][ngram] += count
@@ -0,0 +1,260 @@
+"""
+Module for estimating the Kneser-Ney probabilities of an order with a pool of worker processes.
+
+Within an order, the probability of an ngram only depends on counts, which are read only during the estimation,
+and on the continuation probability of the ngram without its first word, which is of the order below
+and therefore already done. So the ngrams of an order can be estimated in any order, by any process.
+
+Before the estimation, the counts are exported order by order into flat arrays in shared memory
+(multiprocessing.shared_memory), with the ngrams of the order grouped by their string (the ngram without
+its final word), in the order the strings and ngrams were first counted:
+    - freqs:          the frequency of each ngram.
+    - continuations:  the continuation count of each ngram (orders below the highest).
+    - lower:          the index of the ngram without its first word in the arrays of the order below.
+    - offsets:        the index of the first ngram of each string, and the number of ngrams at the end.
+    - string_freqs:   the frequency of each string.
+    - string_continuations: the continuation count of each string.
+The strings of an order are split into ranges with about as many ngrams each, which the workers estimate.
+A worker attaches to the shared arrays (the counts are never copied to it), and writes the probabilities,
+continuation probabilities and backoff weight of its strings into preallocated shared arrays,
+which the order above reads its lower continuation probabilities from.
+
+All terms of a string are summed in the same order as KneserNey.estimate() and KneserNey.backoff_weights() sum them,
+so the probabilities and backoff weights are exactly the same as with the serial estimation.
+"""
+
+import os
+from array import array
+from bisect import bisect_left
+from multiprocessing import Pool, shared_memory
+import instrumentation
+
+_attached = dict()
+
+
+def _attach(name, typecode):
+    """Gets a view of a shared array in a worker, attaching to it the first time."""
+
+    if name not in _attached:
+        memory = shared_memory.SharedMemory(name=name)
+        _attached[name] = (memory, memory.buf.cast(typecode))
+    return _attached[name][1]
+
+
+def _detach(keep):
+    """Detaches a worker from the shared arrays not in keep, i.e. the ones of the orders that are done."""
+
+    for name in list(_attached):
+        if name not in keep:
+            memory, view = _attached.pop(name)
+            view.release()
+            memory.close()
+
+
+def _estimate_strings(task):
+    """Estimates the ngrams of a range of strings of an order. Runs in the worker processes.
+
+    Returns the number of ngrams estimated."""
+
+    first, last, names, D, estimate, estimate_continuations = task
+    _detach(set(names.values()))
+    freqs = _attach(names['freqs'], 'Q')
+    offsets = _attach(names['offsets'], 'Q')
+    string_freqs = _attach(names['string_freqs'], 'Q')
+    weights = _attach(names['weights'], 'd')
+    # The arrays of the probabilities are only shared for the orders whose probabilities are estimated.
+    lower = lower_probs = string_continuations = probs = None
+    continuations = continuation_probs = None
+    if estimate:
+        lower = _attach(names['lower'], 'Q')
+        lower_probs = _attach(names['lower_probs'], 'd')
+        string_continuations = _attach(names['string_continuations'], 'Q')
+        probs = _attach(names['probs'], 'd')
+        if estimate_continuations:
+            continuations = _attach(names['continuations'], 'Q')
+            continuation_probs = _attach(names['continuation_probs'], 'd')
+
+    for string in range(first, last):
+        start, end = offsets[string], offsets[string+1]
+        c_KN_string = 0
+        for i in range(start, end):
+            c_KN_string += freqs[i]
+
+        weight = 0.0
+        for i in range(start, end):
+            freq = freqs[i]
+            weight += min(freq, D[min(freq, 3)]) / c_KN_string
+        weights[string] = weight
+        if not estimate:
+            continue
+
+        lambdas = [d / string_freqs[string] * (end - start) for d in D]
+        continuation_c_KN_string = string_continuations[string]
+        for i in range(start, end):
+            freq = freqs[i]
+            bucket = min(freq, 3)
+            d = D[bucket]
+            backoff = lambdas[bucket] * lower_probs[lower[i]]
+            probs[i] = max(freq - d, 0) / c_KN_string + backoff
+            if estimate_continuations:
+                continuation_probs[i] = max(continuations[i] - d, 0) / continuation_c_KN_string + backoff
+    return offsets[last] - offsets[first]
+
+
+class ParallelKneserNey:
+    """Estimates the probabilities of a KneserNey object with a pool of worker processes, see the module docstring.
+
+    Has the same estimate() and backoff_weights() as KneserNey, so Ngrams can use either."""
+
+    def __init__(self, KN, workers=None, tasks_per_worker=4):
+        """Inits ParallelKneserNey.
+
+        Args:
+            KN: The KneserNey object with the counts and discounts.
+            workers: The number of worker processes. Defaults to the number of cores.
+            tasks_per_worker: How many ranges of strings each order is split into per worker,
+                              so that a worker that is done early can take another range."""
+
+        self.KN = KN
+        self.workers = workers
+        self.tasks_per_worker = tasks_per_worker
+        self._weights = dict()
+        self._blocks = dict()
+
+    def _share(self, typecode, values=None, length=0):
+        """Allocates a block of shared memory for an array, filled with values or with length zeros.
+
+        Returns the name of the block and a view of it as an array."""
+
+        if values is not None:
+            values = array(typecode, values)
+            length = len(values)
+        memory = shared_memory.SharedMemory(create=True, size=max(length, 1) * array(typecode).itemsize)
+        view = memory.buf.cast(typecode)[:length]
+        if values is not None:
+            view[:] = values
+        self._blocks[memory.name] = (memory, view)
+        return memory.name, view
+
+    def _free(self, names):
+        for name in names:
+            memory, view = self._blocks.pop(name)
+            view.release()
+            memory.close()
+            memory.unlink()
+
+    def _layout(self, order):
+        """Groups the ngrams of an order by their string, in the order they were first counted.
+
+        Returns a list of the ngrams, a list of the strings and an array with the index of the first ngram
+        of each string, followed by the number of ngrams."""
+
+        groups = dict()
+        for ngram in self.KN._ngram_lists[order]:
+            groups.setdefault(ngram[:-1], []).append(ngram)
+        ngrams = []
+        offsets = array('Q')
+        for group in groups.values():
+            offsets.append(len(ngrams))
+            ngrams.extend(group)
+        offsets.append(len(ngrams))
+        return ngrams, list(groups), offsets
+
+    def estimate(self, continuation_probs=None, start=1):
+        """Calculates the Kneser-Ney smoothed probabilities of all ngrams, one order at a time, like KneserNey.estimate().
+
+        The backoff weights of the strings are calculated at the same time, see backoff_weights()."""
+
+        KN = self.KN
+        highest_order = max(KN._ngram_lists)
+        D = [KN._D[bucket] for bucket in range(4)]
+
+        ngrams = list(KN._ngram_lists[1])
+        if start <= 1:
+            lower_probs = KN._estimate_unigrams(ngrams)
+            if continuation_probs is not None:
+                continuation_probs.update(lower_probs)
+            yield 1, lower_probs
+        else:
+            lower_probs = continuation_probs
+        lower_name, _ = self._share('d', [lower_probs[ngram] for ngram in ngrams])
+        positions = {ngram: i for i, ngram in enumerate(ngrams)}
+
+        try:
+            with Pool(self.workers) as pool:
+                for order in range(2, highest_order + 1):
+                    estimate = order >= start
+                    estimate_continuations = order < highest_order
+                    ngrams, strings, offsets = self._layout(order)
+                    names = self._export(order, ngrams, strings, offsets, positions, estimate, estimate_continuations)
+                    names['lower_probs'] = lower_name
+                    positions = None
+
+                    with instrumentation.stage('parallel estimation', order=order):
+                        instrumentation.count('strings', len(strings))
+                        done = 0
+                        tasks = self._tasks(offsets, names, D, estimate, estimate_continuations)
+                        for n_ngrams in pool.imap_unordered(_estimate_strings, tasks):
+                            done += n_ngrams
+                            instrumentation.progress(f'{order}-grams', done, len(ngrams))
+
+                    self._weights.update(zip(strings, self._blocks[names['weights']][1]))
+                    next_lower_name = None
+                    if estimate:
+                        probs = dict(zip(ngrams, self._blocks[names['probs']][1]))
+                        if estimate_continuations:
+                            next_lower_name = names.pop('continuation_probs')
+                            if continuation_probs is not None:
+                                continuation_probs.update(zip(ngrams, self._blocks[next_lower_name][1]))
+                        yield order, probs
+                    elif order + 1 >= start and estimate_continuations:
+                        next_lower_name, _ = self._share('d', [continuation_probs[ngram] for ngram in ngrams])
+
+                    self._free([name for name in names.values() if name is not None])
+                    lower_name = next_lower_name
+                    if order < highest_order:
+                        positions = {ngram: i for i, ngram in enumerate(ngrams)}
+        finally:
+            self._free(list(self._blocks))
+
+    def _export(self, order, ngrams, strings, offsets, positions, estimate, estimate_continuations):
+        """Exports the counts of the ngrams of an order into shared memory and allocates the arrays of the results.
+
+        Returns a dict with the names of the shared arrays."""
+
+        KN = self.KN
+        freqs = KN._ngram_lists[order]
+        names = dict()
+        names['freqs'], _ = self._share('Q', [freqs[ngram] for ngram in ngrams])
+        names['offsets'], _ = self._share('Q', offsets)
+        names['string_freqs'], _ = self._share('Q', [KN._ngram_freqs[string] for string in strings])
+        names['weights'], _ = self._share('d', length=len(strings))
+        if estimate:
+            string_continuations = KN._continuation_counts_lower_ngram_strings[order]
+            names['lower'], _ = self._share('Q', [positions[ngram[1:]] for ngram in ngrams])
+            names['string_continuations'], _ = self._share('Q', [string_continuations[string] for string in strings])
+            names['probs'], _ = self._share('d', length=len(ngrams))
+            if estimate_continuations:
+                continuations = KN._continuation_counts[order]
+                names['continuations'], _ = self._share('Q', [continuations[ngram] for ngram in ngrams])
+                names['continuation_probs'], _ = self._share('d', length=len(ngrams))
+        return names
+
+    def _tasks(self, offsets, names, D, estimate, estimate_continuations):
+        """Splits the strings of an order into ranges with about as many ngrams each."""
+
+        n_strings = len(offsets) - 1
+        n_tasks = max((self.workers or os.cpu_count() or 1) * self.tasks_per_worker, 1)
+        size = max(offsets[n_strings] // n_tasks, 1)
+        first = 0
+        while first < n_strings:
+            last = bisect_left(offsets, offsets[first] + size, first + 1, n_strings)
+            yield first, last, names, D, estimate, estimate_continuations
+            first = last
+
+    def backoff_weights(self, strings=None):
+        """Gets the backoff weights of the strings, which estimate() has calculated, like KneserNey.backoff_weights()."""
+
+        if strings is None:
+            return dict(self._weights)
+        return {string: weight for string, weight in self._weights.items() if string in strings}
@@ -0,0 +1,233 @@
+"""
+Module for pruning an estimated ngram model, so that it is smaller and faster to load and query.
+
+Two kinds of pruning are supported, and can be combined:
+    - Count cutoffs: ngrams of an order that have been seen fewer times than the cutoff of that order are pruned.
+    - Relative entropy pruning (Stolcke, 1998): every ngram gets the increase in relative entropy
+      between the model and the model without that ngram, and the ngrams that change the model the least
+      are pruned, either down to a target size or below a threshold.
+
+The unigrams are never pruned, and an ngram is only pruned if all the ngrams it is the string of are pruned too,
+so every ngram that is left can still be found through its string in the binary model.
+
+The probabilities of the ngrams that are left are not changed. A pruned ngram gets its probability
+by backing off, so the backoff weights of the strings that lost ngrams are renormalized: the pruned words and
+the words never seen after the string keep the same probability mass together as before the pruning.
+
+The discounts and the counts of the strings come from all counted ngrams, so the model is pruned after
+it has been estimated but before it is structured and written.
+"""
+
+import math
+import instrumentation
+from collections import defaultdict
+
+_TRADEOFF_SIZES = (1.0, 0.5, 0.25, 0.1)
+
+
+def prune(ngrams, cutoffs=None, target_size=None, threshold=None):
+    """Prunes an estimated Ngrams object.
+
+    The Ngrams object itself is not changed, so its state can still be saved and updated.
+
+    Also reports how the size of the model trades against the perplexity estimated from the relative entropies.
+
+    Args:
+        ngrams: An Ngrams object that build_model() has been called on.
+        cutoffs: A dict with an order as key and the lowest frequency an ngram of that order must have to be kept.
+        target_size: The number of ngrams (of all orders) to prune the model down to with relative entropy pruning.
+        threshold: Ngrams whose relative entropy is below this are pruned.
+
+    Returns:
+        A tuple of two dicts: the logged probabilities and the logged backoff weights of the pruned model."""
+
+    probs, backoffs = ngrams.probs, ngrams.backoffs
+    n = max(len(ngram) for ngram in probs)
+    sizes = [len(ngrams.ngram_lists[order]) for order in range(1, n+1)]
+
+    keep = _cutoff_keep(ngrams.ngram_lists, n, cutoffs or dict())
+    deltas = _relative_entropies(probs, backoffs, n)
+    candidates = _pruning_order(deltas, keep, n)
+
+    pruned = set()
+    size = len(probs)
+    total_delta = 0.0
+    for delta, _, ngram in candidates:
+        if delta == math.inf:
+            break
+        pruned_by_cutoff = ngram not in keep
+        if not pruned_by_cutoff:
+            if target_size is not None and size <= target_size:
+                break
+            if target_size is None and (threshold is None or delta >= threshold):
+                break
+        pruned.add(ngram)
+        size -= 1
+        total_delta += deltas[ngram]
+
+    _report(candidates, deltas, sizes, len(probs), len(pruned), total_delta)
+
+    pruned_probs = {ngram: prob for ngram, prob in probs.items() if ngram not in pruned}
+    pruned_backoffs = {string: weight for string, weight in backoffs.items() if string not in pruned}
+    _renormalize(probs, backoffs, pruned, pruned_probs, pruned_backoffs, n)
+    return pruned_probs, pruned_backoffs
+
+
+def _cutoff_keep(ngram_lists, n, cutoffs):
+    """Gets the ngrams of order > 1 that the count cutoffs keep.
+
+    Goes from the highest order down, so that the string of a kept ngram is kept too."""
+
+    keep = set()
+    for order in range(n, 1, -1):
+        cutoff = cutoffs.get(order, 0)
+        for ngram, freq in ngram_lists[order].items():
+            if freq >= cutoff or ngram in keep:
+                keep.add(ngram)
+                if order > 2:
+                    keep.add(ngram[:-1])
+    return keep
+
+
+def _by_order(ngrams):
+    """Groups ngrams by their order, like Ngrams.ngram_lists, keeping the order they come in within each order."""
+
+    orders = defaultdict(list)
+    for ngram in ngrams:
+        orders[len(ngram)].append(ngram)
+    return orders
+
+
+def _logprob(probs, backoffs, ids):
+    """Gets the logged probability of an ngram in a model given as dicts, backing off like BinaryModel.logprob()."""
+
+    backoff = 0.0
+    while ids not in probs:
+        if len(ids) == 1:
+            return -math.inf
+        backoff += backoffs.get(ids[:-1], 0.0)
+        ids = ids[1:]
+    return backoff + probs[ids]
+
+
+def _unseen_mass(probs, backoffs, ngrams=None):
+    """Gets, for every string, the probability mass the order below gives the words never seen after the string.
+
+    The probabilities of a string are not always normalized, so the mass is at least 0.
+
+    Args:
+        probs: The logged probabilities of the model.
+        backoffs: The logged backoff weights of the model.
+        ngrams: The ngrams seen after the strings. If None, all the ngrams of probs."""
+
+    seen = defaultdict(float)
+    for ngram in probs if ngrams is None else ngrams:
+        if len(ngram) > 1:
+            seen[ngram[:-1]] += math.exp(_logprob(probs, backoffs, ngram[1:]))
+    return {string: max(1 - mass, 0.0) for string, mass in seen.items()}
+
+
+def _relative_entropies(probs, backoffs, n):
+    """Gets how much the relative entropy of the model grows if each ngram of order > 1 is pruned on its own.
+
+    For an ngram hw with the probability p, the backed off probability p' and the string h with the backoff weight b,
+    where U is the mass the order below gives the words never seen after h (see _unseen_mass()),
+    pruning hw gives h the new backoff weight b' = (b*U + p) / (U + p'), and the relative entropy grows by
+        -P(h) * (p * (log(b' * p') - log(p)) + b * U * (log(b') - log(b)))
+    where P(h) is the probability of the string, the product of the probabilities of its prefixes."""
+
+    unseen = _unseen_mass(probs, backoffs)
+    orders = _by_order(probs)
+    history = {ngram: probs[ngram] for ngram in orders[1]}
+
+    deltas = dict()
+    for order in range(2, n+1):
+        for ngram in orders[order]:
+            logprob = probs[ngram]
+            string = ngram[:-1]
+            if order < n:
+                history[ngram] = history[string] + logprob
+
+            p = math.exp(logprob)
+            p_lower = math.exp(_logprob(probs, backoffs, ngram[1:]))
+            weight = math.exp(backoffs.get(string, 0.0))
+            unseen_mass = unseen[string] * weight
+            new_weight = (unseen_mass + p) / (unseen[string] + p_lower)
+
+            delta = p * (math.log(new_weight * p_lower) - logprob)
+            if unseen_mass > 0:
+                delta += unseen_mass * (math.log(new_weight) - math.log(weight))
+            deltas[ngram] = -math.exp(history[string]) * delta
+    return deltas
+
+
+def _pruning_order(deltas, keep, n):
+    """Sorts the ngrams of order > 1 in the order they should be pruned.
+
+    The ngrams that are not kept by the count cutoffs come first. The rest are sorted by their relative entropy,
+    where an ngram's relative entropy is raised to the highest one of the ngrams it is the string of.
+    A string is then never pruned before its ngrams, and on ties the higher order is pruned first.
+
+    Returns a list of (relative entropy, -order, ngram) tuples."""
+
+    orders = _by_order(deltas)
+    highest = dict()
+    candidates = []
+    for order in range(n, 1, -1):
+        for ngram in orders[order]:
+            delta = deltas[ngram]
+            if ngram in keep:
+                delta = max(delta, highest.get(ngram, -math.inf))
+            else:
+                delta = -math.inf
+            candidates.append((delta, -order, ngram))
+            string = ngram[:-1]
+            if order > 2 and highest.get(string, -math.inf) < delta:
+                highest[string] = delta
+    candidates.sort()
+    return candidates
+
+
+def _renormalize(probs, backoffs, pruned, pruned_probs, pruned_backoffs, n):
+    """Renormalizes the backoff weights of the strings that lost ngrams, see the module docstring.
+
+    The new weight of a string h is (b * U + P) / U', where b * U is the mass the unpruned model backed off with,
+    P is the mass of the pruned ngrams after h, and U' is the mass the pruned order below gives the words
+    no longer kept after h. Goes from the lowest order up, so U' is found with the renormalized weights of the
+    order below, which are the ones the pruned model backs off with. Like _unseen_mass(), U and U' take the order
+    below to sum to 1, so where it does not the mass of the string is kept only approximately."""
+
+    unseen = _unseen_mass(probs, backoffs)
+    orders = _by_order(pruned)
+    kept = _by_order(pruned_probs)
+    for order in range(2, n+1):
+        lost = defaultdict(float)
+        for ngram in orders[order]:
+            if ngram[:-1] not in pruned:
+                lost[ngram[:-1]] += math.exp(probs[ngram])
+        if not lost:
+            continue
+
+        pruned_unseen = _unseen_mass(pruned_probs, pruned_backoffs, kept[order])
+        for string, pruned_mass in lost.items():
+            remaining = pruned_unseen.get(string, 1.0)
+            if remaining > 0:
+                weight = math.exp(backoffs.get(string, 0.0))
+                pruned_backoffs[string] = math.log((weight * unseen[string] + pruned_mass) / remaining)
+
+
+def _report(candidates, deltas, sizes, size, n_pruned, total_delta):
+    """Reports the number of ngrams of each order, and the perplexity estimated for a few sizes of the model.
+
+    The perplexity grows by a factor exp(D), where D is the summed relative entropy of the pruned ngrams."""
+
+    instrumentation.message(f'Ngrams per ordning: {sizes}, beskurna: {n_pruned} av {size}')
+    instrumentation.message(f'Uppskattad ökning av perplexiteten: {round((math.exp(total_delta) - 1) * 100, 2)}%')
+
+    cumulative = [0.0]
+    for _, _, ngram in candidates:
+        cumulative.append(cumulative[-1] + deltas[ngram])
+    prunable = len(candidates)
+    for share in _TRADEOFF_SIZES:
+        n_removed = min(round(size * (1 - share)), prunable)
+        instrumentation.message(f'    {size - n_removed} ngrams: +{round((math.exp(cumulative[n_removed]) - 1) * 100, 2)}%')
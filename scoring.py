@@ -0,0 +1,65 @@
+"""
+Module for scoring sentences with a binary ngram model.
+
+The sentences are tokenized and padded the same way as when the model was built,
+so every token and the end of the sentence gets the probability of it following the n-1 words before it.
+"""
+
+import math
+from nltk.tokenize import word_tokenize
+
+
+def score_sentences(model, sentences, batch_size=10000):
+    """Scores a batch of sentences.
+
+    The sentences are handled batch_size at a time. All ngrams of a batch are collected first
+    and then looked up together with BinaryModel.logprobs(), so an ngram that occurs
+    many times in the batch is only looked up once.
+
+    Args:
+        model: A BinaryModel.
+        sentences: An iterable of untokenized sentences.
+        batch_size: The number of sentences whose ngrams are looked up together.
+
+    Returns:
+        A tuple with:
+            - A list with the logged probabilities of the tokens of each sentence,
+              the last one being the probability of the end of the sentence.
+            - A list with the logged probability of each sentence.
+            - The perplexity of all sentences together."""
+
+    token_logprobs = []
+    batch = []
+    for sentence in sentences:
+        batch.append(_ngrams(model, sentence))
+        if len(batch) == batch_size:
+            token_logprobs.extend(_score_batch(model, batch))
+            batch = []
+    token_logprobs.extend(_score_batch(model, batch))
+
+    sentence_logprobs = [sum(logprobs) for logprobs in token_logprobs]
+    n_tokens = sum(len(logprobs) for logprobs in token_logprobs)
+    return token_logprobs, sentence_logprobs, perplexity(sum(sentence_logprobs), n_tokens)
+
+
+def perplexity(logprob, n_tokens):
+    """Gets the perplexity of n_tokens tokens given their summed (natural) logged probability."""
+
+    if n_tokens == 0:
+        return float('inf')
+    return math.exp(-logprob / n_tokens)
+
+
+def _ngrams(model, sentence):
+    """Gets the ngrams of word IDs that a sentence is scored by, one per token and one for the end of the sentence."""
+
+    n = model.n
+    ids = model.encode([word.lower() for word in word_tokenize(sentence)])
+    start, end = model.encode(('<s>', '</s>'))
+    padded = (start,) * (n-1) + ids + (end,)
+    return [padded[i:i+n] for i in range(len(padded) - n + 1)]
+
+
+def _score_batch(model, batch):
+    logprobs = model.logprobs([ngram for ngrams in batch for ngram in ngrams])
+    return [[logprobs[ngram] for ngram in ngrams] for ngrams in batch]
@@ -0,0 +1,183 @@
+"""
+Module for storing a binary model as a directory of segments, which are only opened when they are first used.
+
+A binary model file (see binary_model.py) is split into one segment file per array and order,
+e.g. the probabilities of the trigrams or the ranking of the bigrams, and the vocabulary.
+A small JSON manifest holds the header of the model and the name, type and length of every segment.
+
+SegmentedModel opens only the manifest. A segment is memory mapped the first time it is used, so a query that
+only needs the unigrams and bigrams never opens the higher orders, and the startup does not depend on the size
+of the model. The segments can also be warmed up in a background thread, which reads their files so that the
+first queries do not have to wait for the disk.
+
+The arrays are indexed across the whole order (the trie stores positions in the next order),
+so a segment is a whole array of an order rather than a range of its ngrams.
+"""
+
+import json
+import mmap
+import os
+import sys
+import threading
+import weakref
+from binary_model import BinaryModel
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+_ARRAYS = ('words', 'probs', 'ranking', 'backoffs', 'children')
+_BLOCK_SIZE = 1024 * 1024
+
+
+def write_segments(model_file, directory):
+    """Splits a binary model file into a directory of segments and a manifest."""
+
+    os.makedirs(directory, exist_ok=True)
+    segments = dict()
+    with BinaryModel(model_file) as model:
+        arrays = {'vocab_offsets': model._word_offsets, 'vocab_blob': model._word_blob}
+        for name in _ARRAYS:
+            for order in range(1, model.n+1):
+                array = getattr(model, name)[order]
+                if array is not None:
+                    arrays[f'{name}.{order}'] = array
+
+        for name, array in arrays.items():
+            file = f'{name}.bin'
+            with open(os.path.join(directory, file), 'wb') as fhand:
+                fhand.write(array)
+            segments[name] = {'file': file, 'typecode': array.format, 'length': len(array)}
+
+        manifest = {'version': VERSION, 'byte_order': sys.byteorder, 'n': model.n,
+                    'vocab_size': len(model), 'unk_prob': model.unk_prob, 'segments': segments}
+
+    with open(os.path.join(directory, MANIFEST), 'w', encoding='utf-8') as fhand:
+        json.dump(manifest, fhand, indent=2)
+
+
+class _LazyOrders:
+    """The arrays of one kind, e.g. the probabilities, indexed by order like the lists of BinaryModel.
+
+    The segment of an order is opened when it is first indexed. Orders without a segment are None."""
+
+    def __init__(self, model, name):
+        self._model = model
+        self._name = name
+        self._views = [None] * (model.n+2)
+
+    def __getitem__(self, order):
+        view = self._views[order]
+        if view is None:
+            view = self._views[order] = self._model._segment(f'{self._name}.{order}')
+        return view
+
+
+class SegmentedModel(BinaryModel):
+    """A BinaryModel whose arrays are opened from a directory of segments when they are first used."""
+
+    def __init__(self, directory, warm_up=False):
+        """Opens the manifest of a directory written by write_segments().
+
+        Args:
+            directory: A path to the directory.
+            warm_up: Whether all segments are warmed up in a background thread, see warm_up().
+
+        Raises:
+            ValueError: If the directory has no manifest of this version, or was written with another byte order."""
+
+        try:
+            with open(os.path.join(directory, MANIFEST), encoding='utf-8') as fhand:
+                manifest = json.load(fhand)
+        except (OSError, ValueError) as error:
+            raise ValueError(f'{directory} is not a segmented model: {error}') from error
+        if manifest.get('version') != VERSION:
+            raise ValueError(f'{directory} is not a segmented model of version {VERSION}.')
+        if manifest['byte_order'] != sys.byteorder:
+            raise ValueError(f'{directory} was written with another byte order.')
+
+        self.directory = directory
+        self.n = manifest['n']
+        self.unk_prob = manifest['unk_prob']
+        self._vocab_size = manifest['vocab_size']
+        self._manifest = manifest['segments']
+        self._segments = dict()
+        self._lock = threading.Lock()
+        self._exported = weakref.WeakValueDictionary()
+        self._word2id = None
+        self.words, self.probs, self.ranking, self.backoffs, self.children = [
+            _LazyOrders(self, name) for name in _ARRAYS]
+        self.warm_up_thread = self.warm_up() if warm_up else None
+
+    def _segment(self, name):
+        """Gets the memoryview of a segment, memory mapping its file if it is the first time. None if there is none."""
+
+        segment = self._segments.get(name)
+        if segment is not None:
+            return segment[2]
+        if name not in self._manifest:
+            return None
+
+        with self._lock:
+            if name not in self._segments:
+                info = self._manifest[name]
+                fhand = open(os.path.join(self.directory, info['file']), 'rb')
+                if info['length'] == 0:
+                    mapped, buffer = None, memoryview(b'')
+                else:
+                    mapped = mmap.mmap(fhand.fileno(), 0, access=mmap.ACCESS_READ)
+                    buffer = memoryview(mapped)
+                self._segments[name] = (fhand, mapped, buffer.cast(info['typecode']), buffer)
+        return self._segments[name][2]
+
+    @property
+    def _word_offsets(self):
+        return self._segment('vocab_offsets')
+
+    @property
+    def _word_blob(self):
+        return self._segment('vocab_blob')
+
+    def __len__(self):
+        return self._vocab_size
+
+    def warm_up(self, orders=None, background=True):
+        """Reads the files of segments so that they are in the page cache, and opens them.
+
+        Args:
+            orders: The orders to warm up, e.g. [1, 2]. The vocabulary is always warmed up. Defaults to all orders.
+            background: Whether the segments are warmed up in a daemon thread, which is returned.
+                        Otherwise they are warmed up before returning."""
+
+        names = [name for name in self._manifest
+                 if name.startswith('vocab') or orders is None or int(name.split('.')[1]) in orders]
+        if not background:
+            self._warm_up(names)
+            return None
+        thread = threading.Thread(target=self._warm_up, args=(names,), daemon=True)
+        thread.start()
+        return thread
+
+    def _warm_up(self, names):
+        for name in names:
+            with open(os.path.join(self.directory, self._manifest[name]['file']), 'rb') as fhand:
+                while fhand.read(_BLOCK_SIZE):
+                    pass
+            self._segment(name)
+
+    def close(self):
+        """Releases the memoryviews, also the ones returned by successors(), and closes the files of the opened segments.
+
+        The views can not be used after the model is closed."""
+
+        if self.warm_up_thread is not None:
+            self.warm_up_thread.join()
+        with self._lock:
+            for view in list(self._exported.values()):
+                view.release()
+            for fhand, mapped, view, buffer in self._segments.values():
+                view.release()
+                buffer.release()
+                if mapped is not None:
+                    mapped.close()
+                fhand.close()
+            self._segments = dict()
+        self.words = self.probs = self.ranking = self.backoffs = self.children = None
@@ -0,0 +1,348 @@
+"""
+Module with a local query server, so that many processes can share one open model.
+
+The server opens a binary model once and answers requests on a Unix socket or a localhost TCP port.
+Each request and response is one line of JSON. A request has an "op" and its arguments, and can hold
+a batch of items:
+    {"op": "score", "sentences": ["the cat sat", ...]}
+        -> {"logprobs": [[...], ...], "sentence_logprobs": [...], "perplexity": ...}
+    {"op": "next", "contexts": [["the", "cat"], ...], "k": 5}
+        -> {"words": [[["sat", -1.2], ...], ...]}
+    {"op": "generate", "prompts": ["the", ...], "mode": "beam", "width": 5, "max_length": 50}
+    {"op": "generate", "prompts": ["the", ...], "mode": "sample", "k": 40, "p": 0.9, "temperature": 1.0, "seed": 1}
+        -> {"sentences": ["the cat sat on the mat.", ...]}
+    {"op": "stats"}
+        -> the counters of the server, see ModelServer.stats().
+A request may also have an "id", which is sent back in the response. Errors are answered with {"error": ...},
+and a request that fails is answered on its own without failing the other requests of its batch.
+A request line longer than max_request_size bytes is answered with an error, and the rest of it is skipped.
+
+Requests that arrive at about the same time are coalesced: they are queued, and a single task takes
+all queued requests (waiting batch_window seconds for more) and answers them together in a worker thread, so that
+the connections are still read and written while a large batch is answered. The sentences of all
+score requests in a batch are scored with one call to scoring.score_sentences(), so their ngrams are looked up once.
+The next words of a context are kept in an LRU cache (see generation.py), since the same contexts are asked for again and again.
+
+Usage:
+    python server.py model.bin --socket /tmp/ngram.sock
+    python server.py model.bin --port 8765
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import time
+import instrumentation
+from concurrent.futures import ThreadPoolExecutor
+from binary_model import BinaryModel
+from generation import Generator, detokenize
+from scoring import perplexity, score_sentences
+
+
+class ModelServer:
+    """Serves the queries of an open binary model."""
+
+    def __init__(self, model_file, cache_size=100000, max_batch=256, batch_window=0.001, max_request_size=2**24):
+        """Opens the model.
+
+        Args:
+            model_file: A path to a binary model file.
+            cache_size: The number of (context, k) lookups kept in the LRU cache.
+            max_batch: The largest number of requests answered together.
+            batch_window: How many seconds the batching task waits for more requests after the first one.
+            max_request_size: The longest request line in bytes, the limit of the stream readers.
+
+        self.model = The BinaryModel that is served.
+        self.generator = The Generator of the model, whose cache of next words is the LRU cache of the server.
+        self.counters = A dict with the number of requests, items and errors, and the summed and highest latency, per op."""
+
+        self.model = BinaryModel(model_file)
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.max_request_size = max_request_size
+        self.counters = dict()
+        self.generator = Generator(self.model, cache_size=cache_size)
+        self._queue = None
+        self._batcher = None
+        self._executor = None
+        self._server = None
+        self._started = None
+        self._n_batches = 0
+
+    async def start(self, path=None, host='127.0.0.1', port=None):
+        """Starts listening on a Unix socket if a path is given, otherwise on a TCP port of host."""
+
+        self._queue = asyncio.Queue()
+        # One thread answers the batches, so the model and the counters are only used by one batch at a time.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._batcher = asyncio.create_task(self._batch_loop())
+        self._started = time.perf_counter()
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle_connection, path=path,
+                                                           limit=self.max_request_size)
+        else:
+            self._server = await asyncio.start_server(self._handle_connection, host=host, port=port,
+                                                      limit=self.max_request_size)
+        return self._server
+
+    async def serve_forever(self, path=None, host='127.0.0.1', port=None):
+        server = await self.start(path, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._batcher.cancel()
+        self._executor.shutdown()
+        self.model.close()
+
+    async def _handle_connection(self, reader, writer):
+        """Reads requests from a connection, one line each, and writes back a response line to each."""
+
+        try:
+            while True:
+                future = asyncio.get_running_loop().create_future()
+                try:
+                    line = await self._read_line(reader)
+                    if line is None:
+                        break
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('A request must be a JSON object.')
+                except ValueError as error:
+                    future.set_result({'error': str(error)})
+                else:
+                    await self._queue.put((request, future, time.perf_counter()))
+                response = await future
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _read_line(self, reader):
+        """Reads a request line, or None at the end of the connection.
+
+        Raises:
+            ValueError: The line is longer than max_request_size. The rest of it is skipped first,
+                so the next line can still be read."""
+
+        try:
+            return await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as error:
+            return error.partial or None
+        except asyncio.LimitOverrunError as error:
+            consumed = error.consumed
+            while True:
+                await reader.readexactly(consumed)
+                try:
+                    await reader.readuntil(b'\n')
+                    break
+                except asyncio.IncompleteReadError:
+                    break
+                except asyncio.LimitOverrunError as overrun:
+                    consumed = overrun.consumed
+            raise ValueError(f'The request is longer than {self.max_request_size} bytes.') from error
+
+    async def _batch_loop(self):
+        """Takes the queued requests in batches and answers them in the worker thread."""
+
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            if self.batch_window:
+                await asyncio.sleep(self.batch_window)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                responses = await loop.run_in_executor(self._executor, self._answer, batch)
+            except Exception as error:
+                instrumentation.message(f'Kunde inte besvara {len(batch)} förfrågningar: {error!r}')
+                responses = [{'error': repr(error)}] * len(batch)
+            for (_, future, _), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+
+    def _answer(self, batch):
+        """Answers a batch of requests, scoring the sentences of all score requests together.
+
+        If the sentences can not be scored together, each score request is scored on its own,
+        so that the sentences of one request can not fail the others.
+
+        Runs in the worker thread, so the futures of the requests are left to the event loop.
+
+        Returns:
+            A list with the response of each request."""
+
+        self._n_batches += 1
+        responses = [None] * len(batch)
+        score_requests = []
+        for i, (request, _, _) in enumerate(batch):
+            try:
+                op = request.get('op')
+                if op == 'score':
+                    sentences = request['sentences']
+                    if not isinstance(sentences, list) or not all(isinstance(sentence, str) for sentence in sentences):
+                        raise TypeError('sentences must be a list of strings.')
+                    score_requests.append(i)
+                elif op == 'next':
+                    responses[i] = self.next_words(request['contexts'], request.get('k', 10))
+                elif op == 'generate':
+                    options = {key: request[key] for key in ('mode', 'max_length', 'width', 'k', 'p', 'temperature', 'seed')
+                               if key in request}
+                    responses[i] = self.generate(request['prompts'], **options)
+                elif op == 'stats':
+                    responses[i] = self.stats()
+                else:
+                    raise ValueError(f'Unknown op: {op}')
+            except Exception as error:
+                responses[i] = {'error': repr(error)}
+
+        if score_requests:
+            batches = [batch[i][0]['sentences'] for i in score_requests]
+            try:
+                scores = self.score(batches)
+            except Exception:
+                scores = []
+                for sentences in batches:
+                    try:
+                        scores.extend(self.score([sentences]))
+                    except Exception as error:
+                        scores.append({'error': repr(error)})
+            for i, response in zip(score_requests, scores):
+                responses[i] = response
+
+        now = time.perf_counter()
+        for i, (request, _, received) in enumerate(batch):
+            if 'id' in request:
+                responses[i] = {'id': request['id'], **responses[i]}
+            try:
+                self._count(request.get('op'), request, responses[i], now - received)
+            except Exception as error:
+                instrumentation.message(f'Kunde inte räkna en förfrågan: {error!r}')
+        return responses
+
+    def _count(self, op, request, response, latency):
+        counters = self.counters.setdefault(str(op), {'requests': 0, 'items': 0, 'errors': 0,
+                                                      'latency': 0.0, 'max_latency': 0.0})
+        counters['requests'] += 1
+        for key in ('sentences', 'contexts', 'prompts'):
+            if isinstance(request.get(key), list):
+                counters['items'] += len(request[key])
+                break
+        counters['errors'] += 'error' in response
+        counters['latency'] += latency
+        counters['max_latency'] = max(counters['max_latency'], latency)
+
+    def score(self, batches):
+        """Scores the sentences of several requests together.
+
+        Args:
+            batches: A list with the list of sentences of each request.
+
+        Returns:
+            A list with the response of each request."""
+
+        sentences = [sentence for batch in batches for sentence in batch]
+        token_logprobs, sentence_logprobs, _ = score_sentences(self.model, sentences)
+
+        responses = []
+        start = 0
+        for batch in batches:
+            end = start + len(batch)
+            n_tokens = sum(len(logprobs) for logprobs in token_logprobs[start:end])
+            responses.append({'logprobs': token_logprobs[start:end],
+                              'sentence_logprobs': sentence_logprobs[start:end],
+                              'perplexity': perplexity(sum(sentence_logprobs[start:end]), n_tokens)})
+            start = end
+        return responses
+
+    def next_words(self, contexts, k=10):
+        """Gets the k most probable next words after each context (the words of a sentence so far)."""
+
+        words = []
+        for context in contexts:
+            next_words = self.generator.next_words(self.generator.context(context), k)
+            words.append([[self.model.word(word_id), logprob] for word_id, logprob in next_words])
+        return {'words': words}
+
+    def generate(self, prompts, mode='beam', max_length=50, width=1, k=None, p=None, temperature=1.0, seed=None):
+        """Generates a sentence from each prompt (one or more words), see generation.Generator.
+
+        Args:
+            mode: 'beam' for beam search (greedy with width 1) or 'sample' for top-k or nucleus sampling.
+            The other arguments are the ones of Generator.beam_search() and Generator.sample()."""
+
+        if mode == 'beam':
+            sentences = self.generator.beam_search(prompts, width, max_length)
+        elif mode == 'sample':
+            sentences = self.generator.sample(prompts, k, p, temperature, max_length, seed)
+        else:
+            raise ValueError(f'Unknown mode: {mode}')
+        return {'sentences': [detokenize(words) for words in sentences]}
+
+    def stats(self):
+        """Gets the counters of the server: per op the requests, items, errors and the mean and highest latency
+        in seconds, the number of batches, the requests per second since the start, and the hits and misses of the cache."""
+
+        seconds = time.perf_counter() - self._started
+        ops = dict()
+        n_requests = 0
+        for op, counters in self.counters.items():
+            ops[op] = dict(counters, mean_latency=counters['latency'] / counters['requests'])
+            n_requests += counters['requests']
+        cache = self.generator.next_words.cache_info()
+        return {'ops': ops, 'batches': self._n_batches, 'requests_per_second': n_requests / seconds,
+                'uptime': seconds, 'cache': {'hits': cache.hits, 'misses': cache.misses, 'size': cache.currsize}}
+
+
+class Client:
+    """A blocking client for ModelServer."""
+
+    def __init__(self, path=None, host='127.0.0.1', port=None):
+        """Connects to a server on a Unix socket if a path is given, otherwise on a TCP port of host."""
+
+        if path is not None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(path)
+        else:
+            self._socket = socket.create_connection((host, port))
+        self._file = self._socket.makefile('rwb')
+
+    def request(self, op, **arguments):
+        """Sends a request and returns the response as a dict."""
+
+        self._file.write(json.dumps({'op': op, **arguments}).encode('utf-8') + b'\n')
+        self._file.flush()
+        return json.loads(self._file.readline())
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Serves an ngram model on a local socket.')
+    parser.add_argument('model_file')
+    parser.add_argument('--socket', help='The path of the Unix socket to listen on.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache-size', type=int, default=100000)
+    parser.add_argument('--max-request-size', type=int, default=2**24, help='The longest request line in bytes.')
+    args = parser.parse_args(args)
+
+    server = ModelServer(args.model_file, cache_size=args.cache_size, max_request_size=args.max_request_size)
+    asyncio.run(server.serve_forever(args.socket, args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
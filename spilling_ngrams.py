@@ -0,0 +1,140 @@
+"""
+Module for counting ngrams out of core, for corpora whose text is too large to count in memory.
+
+SpillingNgrams counts into a bounded buffer. When the buffer is full, its ngrams are sorted and
+written to a temporary run file together with their counts, and the buffer is emptied.
+When the counting is done, merge_runs() merges the sorted runs, summing the counts of ngrams
+that are in several runs, and fills in the same tables as Ngrams, so the model is built as usual.
+
+Only the counting is bounded by the memory budget. The merged counts are held in memory like
+the counts of Ngrams, so the distinct ngrams of the corpus and their estimation must still fit in memory,
+and the peak memory of the build after the merge is the same as when counting in memory.
+For counts that do not fit in memory, see approximate_ngrams.py.
+"""
+
+import heapq
+import os
+import tempfile
+from array import array
+from collections import defaultdict
+from ngrams import Ngrams, _int_dict
+
+BYTES_PER_NGRAM = 200  # Rough size of a buffered ngram: the tuple, its ints and its slot in the dict.
+_BLOCK_SIZE = 1024 * 1024
+
+
+def _write_run(path, counts):
+    """Writes the ngrams in counts, sorted, to a run file.
+
+    Each ngram is written as its order, its word IDs and its count, all as unsigned 64 bit ints."""
+
+    records = array('Q')
+    with open(path, 'wb') as fhand:
+        for ngram in sorted(counts):
+            records.append(len(ngram))
+            records.extend(ngram)
+            records.append(counts[ngram])
+            if len(records) >= _BLOCK_SIZE:
+                records.tofile(fhand)
+                del records[:]
+        records.tofile(fhand)
+
+
+def _read_run(path):
+    """Yields the (ngram, count) tuples of a run file in the order they were written, reading a block at a time."""
+
+    records = array('Q')
+    i = 0
+    with open(path, 'rb') as fhand:
+        while True:
+            block = fhand.read(_BLOCK_SIZE * records.itemsize)
+            if not block:
+                break
+            records = records[i:]
+            records.frombytes(block)
+            i = 0
+            while i < len(records) and i + records[i] + 2 <= len(records):
+                order = records[i]
+                yield tuple(records[i+1:i+1+order]), records[i+1+order]
+                i += order + 2
+
+
+class SpillingNgrams(Ngrams):
+    """Ngrams that keeps at most a fixed number of ngrams in memory while counting."""
+
+    def __init__(self, n, memory_budget, tmp_dir=None):
+        """Inits SpillingNgrams.
+
+        Args:
+            n: The highest order of the ngrams.
+            memory_budget: The approximate number of megabytes the counting buffer may use.
+                           It does not bound the merged counts, see the module docstring.
+            tmp_dir: The directory of the run files. Defaults to the system's temporary directory."""
+
+        super().__init__(n)
+        self.max_buffered = max(1, memory_budget * 1024 * 1024 // BYTES_PER_NGRAM)
+        self.tmp_dir = tmp_dir
+        self.runs = []
+        self._buffer = defaultdict(int)
+        self._types_counted = False
+
+    def _count_ngram(self, ngram, n, count=1):
+        """Adds count to the buffered frequency of an ngram, and spills the buffer if it is full."""
+
+        self._buffer[ngram] += count
+        if len(self._buffer) >= self.max_buffered:
+            self._spill()
+
+    def _spill(self):
+        """Writes the buffer as a sorted run file and empties it."""
+
+        fd, path = tempfile.mkstemp(suffix='.run', dir=self.tmp_dir)
+        os.close(fd)
+        _write_run(path, self._buffer)
+        self.runs.append(path)
+        self._buffer = defaultdict(int)
+
+    def merge_runs(self):
+        """Merges the run files and the buffer into the frequency tables of Ngrams.
+
+        The runs are sorted, so a k-way merge gives every ngram once, with the counts of all runs summed.
+        The continuation and succession counts are derived in the same pass, since every merged ngram is distinct.
+        The run files are deleted afterwards."""
+
+        if self._buffer:
+            self._spill()
+
+        self.continuation_counts = defaultdict(_int_dict)
+        self.continuation_counts_lower_ngram_strings = defaultdict(_int_dict)
+        self.succeeding_counts = defaultdict(_int_dict)
+
+        count_ngram = super()._count_ngram
+        previous, total = None, 0
+        try:
+            for ngram, count in heapq.merge(*[_read_run(path) for path in self.runs]):
+                if ngram != previous:
+                    if previous is not None:
+                        self._add_merged(count_ngram, previous, total)
+                    previous, total = ngram, 0
+                total += count
+            if previous is not None:
+                self._add_merged(count_ngram, previous, total)
+        finally:
+            for path in self.runs:
+                os.remove(path)
+            self.runs = []
+        self._types_counted = True
+
+    def _add_merged(self, count_ngram, ngram, count):
+        n = len(ngram)
+        count_ngram(ngram, n, count)
+        if n > 1:
+            self._count_successions(ngram, n)
+        if n > 2:
+            self._count_continuations(ngram, n)
+
+    def _count_types(self):
+        """The types are counted by merge_runs(), so they are only counted here if it has not been called."""
+
+        if not self._types_counted:
+            super()._count_types()
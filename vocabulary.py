@@ -0,0 +1,58 @@
+class Vocabulary:
+    """Maps word types to compact integer IDs and back.
+
+    The ngram counting is done over tuples of integer IDs instead of tuples of strings,
+    since small ints hash and compare faster and take less memory than strings.
+    IDs are handed out in order of first occurrence, so building the same corpus
+    twice gives the same IDs.
+    """
+
+    UNK = '[UNK]'
+    START = '<s>'
+    END = '</s>'
+
+    def __init__(self):
+        """Inits Vocabulary with the reserved tokens.
+
+        self.word2id = A dict mapping each word type to its ID.
+        self.id2word = A list where index i holds the word with ID i.
+        """
+
+        self.word2id = dict()
+        self.id2word = list()
+        self.UNK_ID = self.add(self.UNK)
+        self.START_ID = self.add(self.START)
+        self.END_ID = self.add(self.END)
+
+    def __len__(self):
+        return len(self.id2word)
+
+    def __contains__(self, word):
+        return word in self.word2id
+
+    def add(self, word):
+        """Gets the ID of word, adding it to the vocabulary if it is new."""
+
+        word_id = self.word2id.get(word)
+        if word_id is None:
+            word_id = len(self.id2word)
+            self.word2id[word] = word_id
+            self.id2word.append(word)
+        return word_id
+
+    def encode(self, words, add=True):
+        """Converts a sequence of words to a tuple of IDs.
+
+        If add is False, unseen words are mapped to the ID of [UNK] instead of being added."""
+
+        if add:
+            return tuple([self.add(word) for word in words])
+        get = self.word2id.get
+        unk = self.UNK_ID
+        return tuple([get(word, unk) for word in words])
+
+    def decode(self, ids):
+        """Converts a sequence of IDs back to a tuple of words."""
+
+        id2word = self.id2word
+        return tuple([id2word[i] for i in ids])